@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+""" Load benchmark for the read endpoints of the API
+
+Runs the same request mix with many concurrent clients against one or more running servers and
+reports throughput and latency for each, e.g. to compare a deployment with the sync endpoints to
+one with the async endpoints. Every client keeps one HTTP/1.1 connection open and sends its
+requests one after the other. Only 200 responses are timed, any other status (including the 307
+redirect of a path with or without the trailing slash its route doesn't have) counts as an error.
+Only the standard library is used, so it can run next to the server.
+
+Example
+python load_benchmark.py --url sync=http://localhost:5001 --url async=http://localhost:5000 --concurrency 500
+"""
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+from urllib.parse import urlsplit
+
+# Paths as the routes are declared, /repeats has no trailing slash and the others have one
+DEFAULT_PATHS = [
+    "/repeats?gene_names=BRCA2",
+    "/repeats?region_query=1:1000000-1100000",
+    "/repeatinfo/?repeat_id=1",
+    "/allfreqs/?repeat_id=1",
+    "/gene/?gene_names=BRCA2",
+    "/genefeatures/?gene_names=BRCA2",
+]
+
+async def read_response(reader):
+    """ Read one response and return its status code, the body is read and discarded """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by server")
+    status = int(status_line.split()[1])
+
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get("content-length", 0)))
+    return status, headers.get("connection") == "close"
+
+async def request(reader, writer, host, path):
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nAccept-Encoding: identity\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+    return await read_response(reader)
+
+async def client(host, port, paths, deadline, timeout, latencies, errors):
+    reader = writer = None
+    for path in paths:
+        if time.perf_counter() >= deadline:
+            break
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            start = time.perf_counter()
+            status, close = await asyncio.wait_for(request(reader, writer, host, path), timeout)
+            if status != 200:
+                errors.append(status)
+            else:
+                latencies.append(time.perf_counter() - start)
+            if close:
+                writer.close()
+                writer = None
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            errors.append(type(e).__name__)
+            if writer is not None:
+                writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else float("nan")
+
+async def run(base_url, paths, concurrency, duration, timeout):
+    url = urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+    prefix = url.path.rstrip("/")
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        # Clients start at different points of the request mix
+        client(host, port, (prefix + path for path in itertools.islice(itertools.cycle(paths), i, None)),
+               deadline, timeout, latencies, errors)
+        for i in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return dict(
+        requests = len(latencies),
+        errors = len(errors),
+        timeouts = errors.count("TimeoutError"),
+        throughput = len(latencies) / elapsed,
+        p50 = percentile(latencies, 0.5) * 1000,
+        p95 = percentile(latencies, 0.95) * 1000,
+        p99 = percentile(latencies, 0.99) * 1000,
+        mean = statistics.mean(latencies) * 1000 if latencies else float("nan"),
+    )
+
+def cla_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--url", "-u", type=str, action="append", required=True,
+        help="Server to benchmark as name=base url (e.g. async=http://localhost:5000), can be given several times"
+    )
+    parser.add_argument(
+        "--concurrency", "-c", type=int, default=500, help="Number of concurrent clients"
+    )
+    parser.add_argument(
+        "--duration", "-d", type=float, default=30, help="Seconds to run the benchmark for, per server"
+    )
+    parser.add_argument(
+        "--timeout", "-t", type=float, default=30, help="Seconds after which a request is counted as failed"
+    )
+    parser.add_argument(
+        "--path", "-p", type=str, action="append", help="Request path including the query, defaults to a mix of read endpoints"
+    )
+
+    return parser.parse_args()
+
+def main():
+    args = cla_parser()
+    paths = args.path or DEFAULT_PATHS
+
+    print(f"{'server':<12} {'requests':>9} {'errors':>7} {'timeouts':>9} {'req/s':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for server in args.url:
+        name, _, base_url = server.rpartition("=")
+        result = asyncio.run(run(base_url, paths, args.concurrency, args.duration, args.timeout))
+        print(f"{name or base_url:<12} {result['requests']:>9} {result['errors']:>7} {result['timeouts']:>9} {result['throughput']:>9.1f} "
+              f"{result['mean']:>9.1f} {result['p50']:>9.1f} {result['p95']:>9.1f} {result['p99']:>9.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+""" Time the stages of the gtf_to_sql.py ingestion pipeline
+
+Loads a gtf file into a fresh database (in-memory SQLite unless --database is given) and reports
+how long parsing, building the tables and bulk inserting them take. Gene information is not
+queried from mygene.info, so only local work is measured.
+
+Example
+python benchmark_gtf_to_sql.py --gtf ../data/genome_anntotation/chr1_small_gencode.v22.annotation.gtf
+"""
+import sys
+sys.path.append("..")
+
+import argparse
+import time
+
+from sqlmodel import create_engine, SQLModel, Session
+
+from strAPI.repeats.models import Genome
+from gtf_to_sql import get_genome_annotations, make_genes_table, make_transcripts_table, make_exon_tables, load_annotations
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{label:<24} {time.perf_counter() - start:8.2f} s")
+    return result
+
+def cla_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--gtf", "-g", type=str, default="../data/genome_anntotation/chr1_small_gencode.v22.annotation.gtf", help="Path to the gtf file to load"
+    )
+    parser.add_argument(
+        "--database", "-d", type=str, default="sqlite://", help="Empty database to load into, defaults to in-memory SQLite"
+    )
+
+    return parser.parse_args()
+
+def main():
+    args = cla_parser()
+    engine = create_engine(args.database.replace("postgres://", "postgresql+psycopg2://"), echo=False)
+    SQLModel.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        genome = Genome(name="benchmark", organism="Homo Sapiens", version="benchmark")
+        session.add(genome)
+        session.commit()
+        genome_id = genome.id
+
+    gtf_df = timed("parse gtf", get_genome_annotations, args.gtf)
+    genes = timed("build genes", make_genes_table, gtf_df, genome_id, {}, 1)
+    transcripts = timed("build transcripts", make_transcripts_table, gtf_df, genes, 1)
+    timed("build exons", make_exon_tables, gtf_df, transcripts, 1)
+    counts = timed("build and insert all", load_annotations, engine, gtf_df, genome_id, {})
+
+    print(", ".join(f"{count} {table}" for table, count in counts.items()))
+
+if __name__ == "__main__":
+    main()
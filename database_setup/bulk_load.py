@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+""" Bulk writing of rows into the database, bypassing the ORM
+
+Rows are buffered per table and written in batches, with COPY on PostgreSQL and executemany
+on other databases (SQLite), so that memory stays flat no matter how many rows are loaded.
+"""
+import csv
+import io
+
+from sqlalchemy import func, select, text
+
+DEFAULT_BATCH_SIZE = 10000
+
+def copy_rows(connection, table, rows):
+    """ Write rows (list of dicts keyed by column name) into table in a single round trip
+    """
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+
+    if connection.dialect.name == "postgresql":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[column] for column in columns])
+        buffer.seek(0)
+
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(f'COPY "{table.name}" ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+    else:
+        connection.execute(table.insert(), rows)
+
+def next_id(connection, table):
+    """ First free primary key of table, used to assign ids to rows before they are copied
+    so that link tables can be written in the same batch
+    """
+    return (connection.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+def sync_id_sequence(connection, table):
+    """ After copying rows with explicit ids, move the PostgreSQL id sequence past them
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), COALESCE(MAX(id), 1)) FROM \"{table.name}\""
+        ))
+
+class BulkWriter(object):
+    """ Buffers rows for several tables and writes them in batches
+
+    Tables are flushed in the order they were given, so rows of referenced tables are always
+    written before the rows that point to them.
+
+    Parameters
+    engine:         SQLAlchemy engine of the database to load into
+    tables:         Tables rows will be written to, in foreign key order
+    batch_size:     Number of rows of the first table after which all buffers are flushed
+    """
+    def __init__(self, engine, tables, batch_size=DEFAULT_BATCH_SIZE):
+        self.engine = engine
+        self.tables = list(tables)
+        self.batch_size = batch_size
+        self.buffers = {table.name: [] for table in self.tables}
+        self.written = {table.name: 0 for table in self.tables}
+
+    def add(self, table, row):
+        self.buffers[table.name].append(row)
+        if len(self.buffers[self.tables[0].name]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self.engine.begin() as connection:
+            for table in self.tables:
+                rows = self.buffers[table.name]
+                copy_rows(connection, table, rows)
+                self.written[table.name] += len(rows)
+                self.buffers[table.name] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+""" Set-based upsert of tabular data, replacing per-row ORM lookups in the loaders
+
+Rows are validated and converted to the column types in pandas, staged into a temporary table
+(COPY on PostgreSQL, executemany elsewhere, see bulk_load.copy_rows) and written to the target
+table with INSERT ... SELECT ... ON CONFLICT, one statement per batch of staged rows. Foreign keys
+are resolved by joining the staging table to the referenced tables, so rows pointing to missing
+rows are left out. Every row that is not loaded is written to a rejects file with the reason.
+The whole load is one transaction.
+"""
+import pandas as pd
+from sqlalchemy import Column, Integer, MetaData, Table, and_, exists, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from bulk_load import DEFAULT_BATCH_SIZE, copy_rows
+
+# Values the input files use for missing data, e.g. repeat_id '.' for repeats not in the catalogue
+MISSING_VALUES = (".", "")
+
+def dialect_insert(connection, table):
+    """ INSERT construct of the connection's dialect, which supports ON CONFLICT """
+    if connection.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    if connection.dialect.name == "sqlite":
+        return sqlite.insert(table)
+    raise ValueError(f"Upserts are not supported on {connection.dialect.name}")
+
+def convert(frame, table, columns):
+    """ Convert columns of frame to the python types of the table's columns
+
+    Returns
+    The converted columns (missing values as None) and the reason each row could not be
+    converted, None for rows that could
+    """
+    converted = pd.DataFrame(index=frame.index)
+    reasons = pd.Series(None, index=frame.index, dtype=object)
+    for column in columns:
+        values = frame[column].where(~frame[column].isin(MISSING_VALUES))
+        values = values.where(values.notna(), None)
+        python_type = table.c[column].type.python_type
+        if python_type in (int, float):
+            numbers = pd.to_numeric(values, errors="coerce")
+            invalid = numbers.isna() & values.notna()
+            if python_type is int:
+                invalid |= numbers.notna() & (numbers % 1 != 0)
+                numbers = numbers.where(~invalid)
+                values = numbers.astype("Int64").astype(object)
+            else:
+                values = numbers.astype(object)
+            values = values.where(numbers.notna(), None)
+            reasons = reasons.where(reasons.notna() | ~invalid, f"invalid {column}")
+        if not table.c[column].nullable:
+            reasons = reasons.where(reasons.notna() | values.notna(), f"missing {column}")
+        converted[column] = values
+    return converted, reasons
+
+def staging_table(table, columns):
+    """ Temporary table holding the rows to upsert, with their position in the input as line """
+    return Table(
+        f"staging_{table.name}", MetaData(),
+        Column("line", Integer, primary_key=True, autoincrement=False),
+        *(Column(column, table.c[column].type) for column in columns),
+        prefixes=["TEMPORARY"],
+    )
+
+def bulk_upsert(engine, frame, table, key, columns, references=None, update=True, batch_size=DEFAULT_BATCH_SIZE, rejects_path=None,
+                reasons=None):
+    """ Insert the rows of frame into table, updating (or keeping) rows that already exist
+
+    Parameters
+    engine:                 Engine of the database to load into
+    frame (DataFrame):      Rows to load, with a column per entry of columns
+    table (Table):          Table to load into
+    key (List[str]):        Columns of a unique constraint of table, used as conflict target.
+                            Of several input rows with the same key only the last (first if not
+                            update) is loaded
+    columns (List[str]):    Columns of frame to load
+    references (dict):      Column name to the column of another table it has to match, rows
+                            without a match are rejected
+    update (bool):          Overwrite existing rows with the same key, or leave them unchanged
+    batch_size (int):       Number of staged rows written per INSERT statement
+    rejects_path (str):     CSV file the rejected rows are written to, with a reject_reason column
+    reasons (Series):       Reasons to reject rows found by the caller, None for rows to load
+
+    Returns
+    Dict with the number of rows read, written (inserted or updated) and rejected
+    """
+    references = references or dict()
+    frame = frame.reset_index(drop=True)
+    converted, conversion_reasons = convert(frame, table, columns)
+    if reasons is not None:
+        conversion_reasons = pd.Series(reasons.values, index=frame.index).fillna(conversion_reasons)
+    reasons = conversion_reasons
+
+    valid = reasons.isna()
+    duplicate = converted[valid].duplicated(subset=key, keep="first" if not update else "last")
+    reasons[duplicate[duplicate].index] = "duplicate key, another row with the same key was loaded"
+    valid = reasons.isna()
+
+    staging = staging_table(table, columns)
+    written = 0
+    with engine.begin() as connection:
+        staging.create(connection)
+        rows = converted[valid].assign(line=converted[valid].index)[["line"] + columns].to_dict("records")
+        for start in range(0, len(rows), batch_size):
+            copy_rows(connection, staging, rows[start:start + batch_size])
+
+        # Foreign keys are resolved by joining, rows without a match are reported and skipped
+        source = staging
+        for column, referenced in references.items():
+            referenced_table = referenced.table.alias()
+            match = referenced_table.c[referenced.name] == staging.c[column]
+            missing = connection.execute(select(staging.c.line).where(~exists().where(match))).scalars().all()
+            reasons[missing] = f"{column} not found in {referenced.table.name}.{referenced.name}"
+            source = source.join(referenced_table, match)
+
+        for start in range(0, len(frame), batch_size):
+            selected = select(*(staging.c[column] for column in columns)).select_from(source).where(
+                and_(staging.c.line >= start, staging.c.line < start + batch_size))
+            statement = dialect_insert(connection, table).from_select(columns, selected)
+            if update:
+                statement = statement.on_conflict_do_update(
+                    index_elements=key, set_={column: statement.excluded[column] for column in columns if column not in key})
+            else:
+                statement = statement.on_conflict_do_nothing(index_elements=key)
+            written += connection.execute(statement).rowcount
+
+        staging.drop(connection)
+
+    rejected = reasons.notna()
+    if rejects_path and rejected.any():
+        frame[rejected].assign(reject_reason=reasons[rejected]).to_csv(rejects_path, index=False)
+
+    return dict(read=len(frame), written=written, rejected=int(rejected.sum()))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+""" Bump the dataset version after a load
+
+The API caches responses per dataset version (see strAPI/cache.py), so every loader calls
+bump_data_version once its data is committed. It can also be run by hand after changing the
+database directly.
+
+Example
+python data_version.py --database sqlite:///../db/debug.db --source manual
+"""
+import sys
+sys.path.append("..")
+
+import argparse
+from datetime import datetime
+
+from sqlalchemy import update, insert
+from sqlalchemy.engine import create_engine
+
+from strAPI.repeats.models import DatasetVersion
+
+def bump_data_version(engine, source):
+    """ Increment the dataset version, creating it if the database has none yet
+
+    Parameters
+    engine:         Engine of the database that was loaded
+    source (str):   Name of the loader, stored with the version
+
+    Returns
+    The new version
+    """
+    table = DatasetVersion.__table__
+    with engine.begin() as connection:
+        now = datetime.utcnow()
+        result = connection.execute(
+            update(table).where(table.c.id == 1).values(version=table.c.version + 1, updated_at=now, source=source)
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(id=1, version=1, updated_at=now, source=source))
+        return connection.execute(table.select().where(table.c.id == 1)).one().version
+
+def cla_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--database", "-d", type=str, required=True, help="Database whose dataset version is bumped"
+    )
+    parser.add_argument(
+        "--source", "-s", type=str, default="manual", help="What changed the data, stored with the version"
+    )
+
+    return parser.parse_args()
+
+def main():
+    args = cla_parser()
+    engine = create_engine(args.database.replace("postgres://", "postgresql+psycopg2://"), echo=False)
+    print(f"Dataset version is now {bump_data_version(engine, args.source)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+""" Gene metadata (symbol, name and entrez id) for Ensembl gene ids
+
+Lookups go through a local SQLite cache keyed by Ensembl id. Ids missing from the cache are
+fetched from mygene.info in batches and stored, including the ones mygene doesn't know, so repeated
+loads don't query the network again. In offline mode only the cache is used. The cache can be
+filled up front from an NCBI gene_info dump for machines without network access.
+
+Example
+python gene_info.py --cache ../data/gene_info_cache.sqlite --dump ../data/Homo_sapiens.gene_info.gz
+"""
+import argparse
+import csv
+import gzip
+import sqlite3
+
+GENE_INFO_FIELDS = ["symbol", "name", "entrezgene"]
+DEFAULT_BATCH_SIZE = 1000
+# Maximum number of ids per SQL statement, below SQLite's limit on query parameters
+SQL_BATCH_SIZE = 500
+
+def empty_gene_info():
+    return {field: None for field in GENE_INFO_FIELDS}
+
+def batches(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+class GeneInfoCache(object):
+    """ SQLite file mapping Ensembl ids to gene info. Ids that were looked up but not found are
+    stored with found = 0, so they are not looked up again
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS gene_info (
+                ensembl_id TEXT PRIMARY KEY,
+                symbol TEXT,
+                name TEXT,
+                entrezgene TEXT,
+                found INTEGER NOT NULL
+            )""")
+
+    def get_many(self, ensembl_ids):
+        """ Return {ensembl_id: gene info or None if known to be missing} for the cached ids """
+        cached = dict()
+        for batch in batches(ensembl_ids, SQL_BATCH_SIZE):
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(
+                f"SELECT ensembl_id, symbol, name, entrezgene, found FROM gene_info WHERE ensembl_id IN ({placeholders})", batch
+            )
+            for ensembl_id, symbol, name, entrezgene, found in rows:
+                cached[ensembl_id] = dict(symbol=symbol, name=name, entrezgene=entrezgene) if found else None
+        return cached
+
+    def put_many(self, gene_infos):
+        """ Store {ensembl_id: gene info or None if not found} """
+        rows = []
+        for ensembl_id, info in gene_infos.items():
+            info = self._normalize(info)
+            found = info is not None
+            info = info or empty_gene_info()
+            rows.append((ensembl_id, info["symbol"], info["name"], info["entrezgene"], int(found)))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO gene_info (ensembl_id, symbol, name, entrezgene, found) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def _normalize(info):
+        if info is None:
+            return None
+        return {field: None if info.get(field) is None else str(info[field]) for field in GENE_INFO_FIELDS}
+
+    def import_gene_info_dump(self, dump_path):
+        """ Fill the cache from an NCBI gene_info file (optionally gzipped), using the Ensembl ids
+        listed in its dbXrefs column
+
+        Returns
+        Number of Ensembl ids imported
+        """
+        opener = gzip.open if dump_path.endswith(".gz") else open
+        gene_infos = dict()
+        with opener(dump_path, "rt") as f:
+            reader = csv.DictReader(f, delimiter="\t")
+            for row in reader:
+                xrefs = row["dbXrefs"].split("|")
+                for xref in xrefs:
+                    if xref.startswith("Ensembl:ENSG"):
+                        gene_infos[xref[len("Ensembl:"):]] = dict(
+                            symbol = row["Symbol"],
+                            name = row["description"],
+                            entrezgene = row["GeneID"]
+                        )
+        self.put_many(gene_infos)
+        return len(gene_infos)
+
+class MyGeneResolver(object):
+    """ Looks gene info up on mygene.info in batches """
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        import mygene
+        self.client = mygene.MyGeneInfo()
+        self.batch_size = batch_size
+
+    def resolve(self, ensembl_ids):
+        gene_infos = dict()
+        for batch in batches(ensembl_ids, self.batch_size):
+            for result in self.client.getgenes(batch, fields=",".join(GENE_INFO_FIELDS)):
+                if result.get("notfound"):
+                    gene_infos[result["query"]] = None
+                else:
+                    gene_infos[result["query"]] = {field: result.get(field) for field in GENE_INFO_FIELDS}
+        return gene_infos
+
+class CachedResolver(object):
+    """ Answers from the cache first and asks remote (if any) only for the missing ids
+
+    Parameters
+    cache (GeneInfoCache):      Local cache, updated with everything remote returns
+    remote:                     Resolver used for ids missing from the cache, None for offline mode
+    """
+    def __init__(self, cache, remote=None):
+        self.cache = cache
+        self.remote = remote
+
+    def resolve(self, ensembl_ids):
+        ensembl_ids = set(ensembl_ids)
+        gene_infos = self.cache.get_many(ensembl_ids)
+        missing = ensembl_ids - gene_infos.keys()
+        if missing and self.remote is not None:
+            fetched = self.remote.resolve(missing)
+            self.cache.put_many(fetched)
+            gene_infos.update(fetched)
+        return gene_infos
+
+def make_resolver(cache_path=None, offline=False):
+    """ Resolver for the given options: cached if a cache path is given, remote unless offline """
+    if offline and cache_path is None:
+        raise ValueError("Offline mode needs a gene info cache")
+    remote = None if offline else MyGeneResolver()
+    if cache_path is None:
+        return remote
+    return CachedResolver(GeneInfoCache(cache_path), remote)
+
+def cla_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--cache", "-c", type=str, required=True, help="Path of the SQLite gene info cache, created if it doesn't exist"
+    )
+    parser.add_argument(
+        "--dump", type=str, required=True, help="NCBI gene_info file (e.g. Homo_sapiens.gene_info.gz) to import into the cache"
+    )
+
+    return parser.parse_args()
+
+def main():
+    args = cla_parser()
+    cache = GeneInfoCache(args.cache)
+    count = cache.import_gene_info_dump(args.dump)
+    print(f"Imported gene info for {count} Ensembl ids into {args.cache}")
+
+if __name__ == "__main__":
+    main()
@@ -5,23 +5,34 @@ sys.path.append("..")
 import argparse
 import os
 import io
+import numpy as np
 import pandas as pd
 import urllib.parse
 import urllib.request
 import gtfparse
-from sqlalchemy import Index
+from sqlalchemy import Index, select
 from sqlalchemy import exc
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import NoResultFound
-import mygene
-from strAPI.repeats.models import Gene, Transcript, Exon, Genome
+from strAPI.repeats.models import Gene, Transcript, Exon, Genome, ExonTranscriptsLink
+from strAPI.utils.binning import region_to_bin
+from bulk_load import copy_rows, next_id, sync_id_sequence
+from gene_info import make_resolver
+from data_version import bump_data_version
 
 GENE_TYPE_NAME = "gene"
+EXON_FEATURES = ["CDS", "start_codon", "stop_codon"]
+# Used for genes for which no information could be found
+EMPTY_GENE_INFO = {"symbol": None, "name": None, "entrezgene": None}
+
 def get_genome_annotations(gtf_handle, protein_coding=True):
     """ Parsing and optional filtering of gtf genome annotation file into pd.DataFrame
     """
-    gtf_df = gtfparse.read_gtf(gtf_handle)
+    gtf_df = gtfparse.read_gtf(gtf_handle, result_type="pandas")
+    gtf_df["seqname"] = gtf_df["seqname"].astype(str)
+    gtf_df["feature"] = gtf_df["feature"].astype(str)
+    gtf_df["strand"] = gtf_df["strand"].astype(str)
 
     if protein_coding:
         # Select only protein coding genes from the gtf
@@ -29,139 +40,162 @@ def get_genome_annotations(gtf_handle, protein_coding=True):
 
     return gtf_df
 
-def add_genes(session, gtf_df, genome):
-    """ Get desired field values for all genes from a gtf data frame. For each gene in the gtf file,
-    create a Gene instance. Finally, add all encountered Genes to the session
+def make_genes_table(gtf_df, genome_id, gene_infos, first_id):
+    """ Build the rows of the genes table from a gtf data frame
 
-    Parameters 
-    session:        A SQLAlchemy session that is connected to a database where information from the genome
-                    annotation file will be stored
-    gtf_df (pd.DataFrame):  
+    Parameters
+    gtf_df (pd.DataFrame):
                     Pandas data frame of gtf genome annotation file. Specifically one produced
                     using gtfparse.read_gtf()
+    genome_id (int):
+                    Id of the Genome the genes belong to
+    gene_infos (dict):
+                    Gene information from query_gene_info, keyed by unversioned ensembl id
+    first_id (int): Id given to the first gene, the others are numbered consecutively
+
+    Returns
+    pd.DataFrame with one row per gene and the columns of the genes table
     """
-    gene_list = []
-    gene_infos = query_gene_info(gtf_df)
-    
+    genes = gtf_df.loc[gtf_df["feature"] == GENE_TYPE_NAME].reset_index(drop=True)
+    ensembl_ids = genes["gene_id"].str.split(".").str[0]  # emsebl gene id without version number
+    infos = [gene_infos.get(ensembl_id, EMPTY_GENE_INFO) for ensembl_id in ensembl_ids]
+
+    return pd.DataFrame({
+        "id": np.arange(first_id, first_id + len(genes)),
+        "ensembl_id": ensembl_ids,
+        "ensembl_version_id": genes["gene_id"],
+        "entrez_id": [info["entrezgene"] for info in infos],
+        "name": [info["symbol"] for info in infos],
+        "description": [info["name"] for info in infos],
+        "chr": genes["seqname"],
+        "strand": genes["strand"],
+        "start": genes["start"],
+        "end": genes["end"],
+        "bin": [region_to_bin(start, end) for start, end in zip(genes["start"], genes["end"])],
+        "genome_id": genome_id
+    })
+
+def make_transcripts_table(gtf_df, genes_table, first_id):
+    """ Build the rows of the transcripts table, linked to their genes by versioned ensembl id
+    """
+    transcripts = gtf_df.loc[gtf_df["feature"] == "transcript", ["gene_id", "transcript_id", "start", "end"]]
+    transcripts = transcripts.merge(
+        genes_table[["id", "ensembl_version_id"]].rename(columns={"id": "gene_pk"}),
+        left_on="gene_id", right_on="ensembl_version_id", how="inner"
+    ).reset_index(drop=True)
+
+    return pd.DataFrame({
+        "id": np.arange(first_id, first_id + len(transcripts)),
+        "ensembl_transcript": transcripts["transcript_id"],
+        "start": transcripts["start"],
+        "end": transcripts["end"],
+        "gene_id": transcripts["gene_pk"]
+    })
+
+def make_exon_tables(gtf_df, transcripts_table, first_id, existing_exons=None):
+    """ Build the rows of the exons and exons_transcripts tables
+
+    One exon can appear in several transcripts. Its CDS, start codon and stop codon are taken
+    from the rows of the first transcript it appears in, exons already in the database
+    (existing_exons, ensembl_exon -> id) are only linked to the new transcripts.
+
+    Returns
+    Tuple of pd.DataFrame (exons, exons_transcripts)
+    """
+    existing_exons = existing_exons or dict()
+    exon_rows = gtf_df.loc[gtf_df["feature"] == "exon", ["transcript_id", "exon_id", "start", "end"]]
+
+    first_rows = exon_rows.drop_duplicates("exon_id")
+    first_rows = first_rows.loc[~first_rows["exon_id"].isin(existing_exons.keys())].reset_index(drop=True)
+
+    features = gtf_df.loc[gtf_df["feature"].isin(EXON_FEATURES), ["feature", "transcript_id", "exon_id", "start"]]
+    features = features.merge(first_rows[["transcript_id", "exon_id"]], on=["transcript_id", "exon_id"], how="inner")
+    codons = features.loc[features["feature"] != "CDS"].groupby(["exon_id", "feature"])["start"].last().unstack()
+    codons = codons.reindex(columns=["start_codon", "stop_codon"])
+
+    exons = pd.DataFrame({
+        "id": np.arange(first_id, first_id + len(first_rows)),
+        "ensembl_exon": first_rows["exon_id"],
+        "start": first_rows["start"],
+        "end": first_rows["end"],
+        "cds": first_rows["exon_id"].isin(features.loc[features["feature"] == "CDS", "exon_id"]),
+        "start_codon": first_rows["exon_id"].map(codons["start_codon"]).astype("Int64"),
+        "stop_codon": first_rows["exon_id"].map(codons["stop_codon"]).astype("Int64")
+    })
+
+    exon_ids = pd.concat([
+        pd.Series(existing_exons, dtype="int64"),
+        pd.Series(exons["id"].values, index=exons["ensembl_exon"].values)
+    ])
+    transcript_ids = pd.Series(transcripts_table["id"].values, index=transcripts_table["ensembl_transcript"].values)
+    exons_transcripts = pd.DataFrame({
+        "exon_id": exon_rows["exon_id"].map(exon_ids).values,
+        "transcript_id": exon_rows["transcript_id"].map(transcript_ids).values
+    }).dropna().astype("int64").drop_duplicates()
+
+    return exons, exons_transcripts
+
+def table_records(df):
+    """ Rows of a data frame as dicts of plain Python values, with None for missing values
+    """
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+def load_annotations(engine, gtf_df, genome_id, gene_infos):
+    """ Build the gene, transcript, exon and exon-transcript tables from the gtf data frame in
+    memory and write each of them to the database in one bulk insert
+
+    Returns
+    Dict with the number of rows written per table
+    """
+    with engine.connect() as connection:
+        first_gene_id = next_id(connection, Gene.__table__)
+        first_transcript_id = next_id(connection, Transcript.__table__)
+        first_exon_id = next_id(connection, Exon.__table__)
+        existing_exons = dict(connection.execute(select(Exon.__table__.c.ensembl_exon, Exon.__table__.c.id)).fetchall())
+
+    genes = make_genes_table(gtf_df, genome_id, gene_infos, first_gene_id)
+    transcripts = make_transcripts_table(gtf_df, genes, first_transcript_id)
+    exons, exons_transcripts = make_exon_tables(gtf_df, transcripts, first_exon_id, existing_exons)
+
+    tables = [(Gene.__table__, genes), (Transcript.__table__, transcripts),
+              (Exon.__table__, exons), (ExonTranscriptsLink.__table__, exons_transcripts)]
+    with engine.begin() as connection:
+        for table, df in tables:
+            copy_rows(connection, table, table_records(df))
+        for table in (Gene.__table__, Transcript.__table__, Exon.__table__):
+            sync_id_sequence(connection, table)
+
+    return {table.name: len(df) for table, df in tables}
+
+def query_gene_info(gtf_df, resolver=None):
+    """ Gene information (symbol, name and entrezgene) for all genes in the gtf data frame
+
+    Parameters
+    gtf_df (pd.DataFrame):
+                    Pandas data frame of gtf genome annotation file
+    resolver:       Object with a resolve(ensembl_ids) method, see gene_info.py. Defaults to
+                    querying mygene.info without a cache
+
+    Returns
+    Dict keyed by unversioned ensembl id, fields are None for genes without information
+    """
+    ensembl_ids = set(gtf_df.loc[gtf_df["feature"] == GENE_TYPE_NAME, "gene_id"].str.split(".").str[0])
+    if resolver is None:
+        resolver = make_resolver()
+    resolved = resolver.resolve(ensembl_ids)
 
-    for index, row in gtf_df.loc[(gtf_df["feature"] == "gene")].iterrows():
-        ensembl_id = row["gene_id"].split(".")[0]  # emsebl gene id without version number
-        gene_info = gene_infos[ensembl_id]
-
-        gene = Gene(
-                ensembl_id = ensembl_id,
-                ensembl_version_id = row["gene_id"],
-                entrez_id = gene_info["entrezgene"],
-                name = gene_info["symbol"],
-                description = gene_info["name"],
-                chr = row["seqname"],
-                start = row["start"],
-                end = row["end"],
-                strand = row["strand"],
-                genome_id = genome.id
-            )
-       
-        gene_list.append(gene)
-        genome.genes.append(gene)
-    session.add_all(gene_list)
-
-def query_gene_info(gtf_df, query_fields=["name", "symbol", "entrezgene"]):    
-    ensembl_ids = set()
-    for index, row in gtf_df.loc[(gtf_df["feature"] == "gene")].iterrows():
-        ensembl_ids.add(row["gene_id"].split(".")[0])
-    response = mygene.MyGeneInfo().getgenes(ensembl_ids, fields=",".join(query_fields))
-    
     gene_infos = dict()
     not_found_counter = 0
-    for result in response:
-        try:
+    for ensembl_id in ensembl_ids:
+        info = resolved.get(ensembl_id)
+        if info is None:
             # create placeholder dict if no info was found
-            if result['notfound']:
-                gene_infos[result['query']] = {                    
-                    "symbol": None,
-                    "name": None,
-                    "entrezgene": None,
-                }
-                not_found_counter += 1
-                continue
-        except KeyError:
-            # something was found, but need to check for each field whether it was found or not
-            # otherwise they will be missing and KeyErrors will be raised later on
-            for field in query_fields:
-                    try:
-                        result[field]
-                    except KeyError:
-                        result[field] = None
-        gene_infos[result['query']] = result
+            info = dict(EMPTY_GENE_INFO)
+            not_found_counter += 1
+        gene_infos[ensembl_id] = info
     print(f"No gene information could be found for {not_found_counter} out of {len(ensembl_ids)} genes")
     return gene_infos
 
-def add_transcripts(session, gtf_df):
-    """ Get desired field values for all transcripts from a gtf data frame, add them to their respective
-    genes in the session
-
-    Parameters
-    session:        A SQLAlchemy session that is connected to a database where information from the genome
-                    annotation file will be stored
-    gtf_df (pd.DataFrame):  
-                    Pandas data frame of gtf genome annotation file. Specifically one produced
-                    using gtfparse.read_gtf()
-    """
-    for index, row in gtf_df.loc[(gtf_df["feature"] == "transcript")].iterrows():     
-        ensembl_id = row["gene_id"].split(".")[0]  # emsebl gene id without version number
-        gene = session.query(Gene).filter_by(ensembl_id = ensembl_id).one()
-        gene.transcripts.append(
-            Transcript(
-                ensembl_transcript=row["transcript_id"],
-                start=row["start"],
-                end=row["end"]
-            )
-        )
-
-def add_exons(session, gtf_df):
-    """ Get desired field values for all exons from a gtf data frame, add them to their transcripts
-    in the session
-    
-    Parameters
-    session:        A SQLAlchemy session that is connected to a database where information from the genome
-                    annotation file will be stored
-    gtf_df (pd.DataFrame):  
-                    Pandas data frame of gtf genome annotation file. Specifically one produced
-                    using gtfparse.read_gtf()
-    """        
-    # Multiple successive rows in the gtf file describe different features for one exon: exon, CDS, start_codon and stop_codon
-    ## One exon can also appear multiple times in the same gtf file (for different transcripts)
-    for index, row in gtf_df[gtf_df["feature"].isin({"exon", "CDS", "start_codon", "stop_codon"})].iterrows():
-        if row["feature"] == "exon":   
-            skip = False
-            # get the transript the exon belongs to from the session
-            transcript = session.query(Transcript).filter_by(ensembl_transcript = row["transcript_id"]).one()
-            # get exon id from the row            
-            ensembl_exon=row["exon_id"]            
-            try:
-                # if an Exon with this id was already generated for a prior Transcript, just add the Exon to
-                ## the current Transcript. Also skip the next few rows that contain info on Exon features as 
-                ### they should already be known from previous encounter
-                existing_exon = session.query(Exon).filter_by(ensembl_exon=ensembl_exon).one()
-                transcript.exons.append(existing_exon)
-                skip = True
-            except NoResultFound:
-                # Exon was not observed before, make new Exon and parse feature information from the next few rows in the file
-                new_exon = Exon(ensembl_exon=row["exon_id"], start=row["start"], end=row["end"], cds=False)            
-                transcript.exons.append(new_exon)
-
-        elif row["feature"] == "CDS" and not skip:
-            # does the exon contain coding sequence?
-            new_exon.cds = True
-
-        elif row["feature"] == "start_codon" and not skip:
-            # does the exon contain a start codon? If so: store the first position of the start codon
-            new_exon.start_codon = row["start"]
-
-        elif row["feature"] == "stop_codon" and not skip:
-            # does the exon contain a stop codon? If so: store the first position of the stop codon
-            new_exon.stop_codon = row["start"]
-
 def connection_setup(db_path):
     # check if database exists
     #if not os.path.exists(db_path):
@@ -188,6 +222,12 @@ def cla_parser():
     parser.add_argument(
         "--assembly", "-a", type=str, required=True, help="Genome assembly name in db"
     )
+    parser.add_argument(
+        "--gene_info_cache", type=str, default=None, help="Path of a SQLite cache for gene information, see gene_info.py"
+    )
+    parser.add_argument(
+        "--offline", action="store_true", help="Only use the gene information cache, don't query mygene.info"
+    )
 
     return parser.parse_args()
 
@@ -211,24 +251,24 @@ def main():
     gtf_df = get_genome_annotations(gtf_handle, protein_coding=True)
 
     genome = session.query(Genome).filter(Genome.version == assembly).one()
-
-    # add genes, transcripts and exons from the gtf file to the session
-    add_genes(session, gtf_df, genome)
-    add_transcripts(session, gtf_df)
-    add_exons(session, gtf_df)
-
-    # commit new additions to the database before adding indexes, otherwise sqlalchemy will complain
-    ## that the 'database is locked'
+    # end the session's transaction before writing through the engine, otherwise sqlite will
+    ## complain that the 'database is locked'
     session.commit()
 
+    # build genes, transcripts and exons from the gtf file and bulk insert them
+    resolver = make_resolver(args.gene_info_cache, args.offline)
+    counts = load_annotations(engine, gtf_df, genome.id, query_gene_info(gtf_df, resolver))
+    print(", ".join(f"{count} {table}" for table, count in counts.items()) + " inserted")
+
     # add indexes to row that will likely be queried a lot
     # ensembl ID columns for Gene, Transcript, Exon
-    Index('ensembl_id_idx', Gene.ensembl_id).create(engine)
-    Index('ensembl_transcript_idx', Transcript.ensembl_transcript).create(engine)
-    Index('ensembl_exon_idx', Exon.ensembl_exon).create(engine)
+    Index('ensembl_id_idx', Gene.ensembl_id).create(engine, checkfirst=True)
+    Index('ensembl_transcript_idx', Transcript.ensembl_transcript).create(engine, checkfirst=True)
+    Index('ensembl_exon_idx', Exon.ensembl_exon).create(engine, checkfirst=True)
 
     # commit
     session.commit()
+    bump_data_version(engine, "gtf_to_sql")
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,14 @@
 """
-This script imports gene expression and repeat length correlation data from a csv file into a database. 
+This script imports gene expression and repeat length correlation data from a csv file into a database.
 It uses the gtf_to_sql module to connect to the database and the pandas module to read the csv file.
 It inserts data into CRCExprRepeatLenCorr model.
 
+Repeats are matched against the gangstr_crc_hg38 TR panel, which is loaded once into sorted arrays
+per chromosome: a row matches the repeat starting at its position, or else a repeat containing
+that position. Matching is done for all rows at once with numpy searchsorted, and the
+correlations are written with a single bulk upsert (see bulk_upsert.py). Rows whose repeat or
+gene is not found are written to a rejects file.
+
 The script defines a command-line interface using the argparse module.
 The script can be run from the command line with the --database and --file arguments to specify the database and csv file paths.
 
@@ -13,79 +19,83 @@ Script can be run multiple times. It will update existing records and insert new
 import argparse
 import logging
 from gtf_to_sql import connection_setup
+from data_version import bump_data_version
+from bulk_load import DEFAULT_BATCH_SIZE
+from bulk_upsert import bulk_upsert
+import numpy as np
 import pandas as pd
+from sqlalchemy import select
 
 from strAPI.repeats.models import Gene, Repeat, CRCExprRepeatLenCorr, TRPanel
 
-
-def update_db_record(df_row, session, genes_by_code, inserted_entities):
-
-    gangstr_crc_hg38_panel = session.query(TRPanel).filter_by(name='gangstr_crc_hg38').first()
-        
-    def get_repeat(tmp_id, range=False):
-        chr, start = tmp_id.split("_")
-        start = int(start)
-        # filterning only repeats from gangstr_crc_hg38 tr panel
-        query = session.query(Repeat).filter_by(chr=chr.lower()).filter_by(
-            trpanel_id=gangstr_crc_hg38_panel.id)
-        if range:
-            query = query.filter(Repeat.start<=start).filter(Repeat.end>start)
-        else:
-            query = query.filter_by(start=start)
-
-        result = query.limit(2).all()
-        if len(result) > 1:
-            logging.warning(f"More than one repeat found for {tmp_id} \n{result[0]} \n{result[1]}")
-
-        return result[0] if len(result) > 0 else None
-
-    repeat = get_repeat(df_row["tmp_id"].strip())
-    gene = genes_by_code.get(df_row["gene"].strip())
-
-    repeat_id = None
-    gene_id = None
- 
-    if repeat is None:
-        logging.info(
-            f"Repeat {len(inserted_entities)} with code {df_row['tmp_id']} not found in database. Range search can help.")
-        repeat = get_repeat(df_row["tmp_id"].strip(), range=True)
-        if repeat is None:
-            logging.info(
-                    f"Repeat {len(inserted_entities)} with code {df_row['tmp_id']} not found in database.")
-        
-    if gene is None:
-        logging.info(
-            f"Gene {len(inserted_entities)} with code {df_row['gene']} not found in database.")
-
-    if repeat is not None and gene is not None:
-        gene_id = gene.id
-        repeat_id = repeat.id
-    else:
-        return
-
-    entity = session.query(CRCExprRepeatLenCorr).filter_by(
-        repeat_id=repeat_id,
-        gene_id=gene_id
-    ).first()
-
-    if entity is None:
-
-        entity = CRCExprRepeatLenCorr(
-            repeat_id   = repeat_id,
-            gene_id     = gene_id
-        )
-
-        session.add(entity)
-    
-    entity.gene_id = gene_id
-    entity.repeat_id = repeat_id
-    entity.coefficient = df_row["coefficient"]
-    entity.intercept = df_row["intercept"]
-    entity.p_value = df_row["pvalue_coef"]
-    entity.p_value_corrected = df_row["pvalue_corrected"]
-
-    inserted_entities.append(entity)
-
+PANEL_NAME = "gangstr_crc_hg38"
+
+CORRELATION_COLUMNS = ["repeat_id", "gene_id", "coefficient", "intercept", "p_value", "p_value_corrected"]
+
+class PanelRepeats(object):
+    """ Repeats of a TR panel as arrays sorted by start, per chromosome """
+    def __init__(self, frame):
+        self.chromosomes = dict()
+        for chrom, repeats in frame.sort_values(["chr", "start", "id"]).groupby("chr"):
+            starts, ends = repeats["start"].to_numpy(), repeats["end"].to_numpy()
+            # Largest end of the repeats up to each position, to tell whether any of them contains a point
+            self.chromosomes[chrom] = (starts, ends, np.maximum.accumulate(ends), int((ends - starts).max()), repeats["id"].to_numpy())
+
+    @classmethod
+    def load(cls, engine, panel_name):
+        with engine.connect() as connection:
+            panel_id = connection.execute(select(TRPanel.id).where(TRPanel.name == panel_name)).scalar_one()
+            rows = connection.execute(
+                select(Repeat.chr, Repeat.start, Repeat.end, Repeat.id).where(Repeat.trpanel_id == panel_id)).all()
+        return cls(pd.DataFrame(rows, columns=["chr", "start", "end", "id"]))
+
+    def match(self, chrom, positions):
+        """ Ids of the repeats of chrom starting at positions, or else containing them (start <= position < end),
+        -1 where there is none. Of several repeats starting at a position the one with the lowest id is
+        taken, of several containing it the one starting closest to it
+        """
+        ids = np.full(len(positions), -1, dtype=np.int64)
+        if chrom not in self.chromosomes:
+            return ids
+        starts, ends, max_ends, max_length, repeat_ids = self.chromosomes[chrom]
+
+        # Exact matches on the start
+        first = np.searchsorted(starts, positions, side="left")
+        inside = first < len(starts)
+        exact = inside & (starts[np.minimum(first, len(starts) - 1)] == positions)
+        ids[exact] = repeat_ids[first[exact]]
+        ambiguous = exact & (first + 1 < len(starts)) & (starts[np.minimum(first + 1, len(starts) - 1)] == positions)
+        if ambiguous.any():
+            logging.warning(f"More than one repeat starts at {ambiguous.sum()} positions on {chrom}, taking the first")
+
+        # Containing repeats for the others: the last repeat starting at or before the position
+        # contains it, unless a longer one starting earlier does (then max_ends tells there is one)
+        last = np.searchsorted(starts, positions, side="right") - 1
+        candidates = ~exact & (last >= 0)
+        last = np.maximum(last, 0)
+        contained = candidates & (ends[last] > positions)
+        ids[contained] = repeat_ids[last[contained]]
+        for i in np.flatnonzero(candidates & ~contained & (max_ends[last] > positions)):
+            # Only repeats starting within the longest repeat length before the position can contain it
+            window = slice(np.searchsorted(starts, positions[i] - max_length, side="left"), last[i] + 1)
+            containing = np.flatnonzero(ends[window] > positions[i])
+            if len(containing):
+                ids[i] = repeat_ids[window][containing[-1]]
+        return ids
+
+def match_repeats(panel, tmp_ids):
+    """ Ids of the panel repeats for codes like chr7_100359506, -1 where not found """
+    parts = tmp_ids.str.strip().str.rsplit("_", n=1, expand=True)
+    chroms = parts[0].str.lower()
+    positions = pd.to_numeric(parts[1], errors="coerce").fillna(-1).astype(np.int64)
+    ids = pd.Series(-1, index=tmp_ids.index, dtype=np.int64)
+    for chrom, rows in chroms.groupby(chroms):
+        ids[rows.index] = panel.match(chrom, positions[rows.index].to_numpy())
+    return ids
+
+def load_gene_ids(engine):
+    with engine.connect() as connection:
+        return dict(connection.execute(select(Gene.ensembl_id, Gene.id)).all())
 
 def cla_parser():
     parser = argparse.ArgumentParser()
@@ -96,6 +106,12 @@ def cla_parser():
     parser.add_argument(
         "--file", "-f", type=str, required=True, help="Path to variations file in csv format"
     )
+    parser.add_argument(
+        "--rejects", "-r", type=str, help="CSV file for rows that could not be loaded, defaults to the input path with .rejected.csv appended"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of rows written per statement"
+    )
 
     return parser.parse_args()
 
@@ -103,33 +119,37 @@ def cla_parser():
 def main():
     args = cla_parser()
     db_path = args.database
-    db_path = db_path.replace("postgres://", "postgresql+psycopg2://") 
+    db_path = db_path.replace("postgres://", "postgresql+psycopg2://")
 
     input_path = args.file
     logging.info("Connecting to the database")
     engine, session = connection_setup(db_path)
 
-    inserted_entities = []
-
-    logging.info("Getting all genes from database")
-    genes_by_ensemble_code = {}
-    for gene in session.query(Gene).all():
-        genes_by_ensemble_code[gene.ensembl_id] = gene
-    logging.info(f"Got {len(genes_by_ensemble_code)} genes from database")
+    logging.info("Getting all genes and the repeats of the panel from database")
+    gene_ids = load_gene_ids(engine)
+    panel = PanelRepeats.load(engine, PANEL_NAME)
+    logging.info(f"Got {len(gene_ids)} genes from database")
 
     logging.info("Inserting gene expretion and repeat length correlation")
     data_frame = pd.read_csv(input_path)
-    input_csv_len = len(data_frame)
-    data_frame.apply(lambda row: update_db_record(row, session,
-                     genes_by_ensemble_code, inserted_entities), axis=1)
+    data_frame["repeat_id"] = match_repeats(panel, data_frame["tmp_id"])
+    data_frame["gene_id"] = data_frame["gene"].str.strip().map(gene_ids)
+    data_frame = data_frame.rename(columns={"pvalue_coef": "p_value", "pvalue_corrected": "p_value_corrected"})
+
+    reasons = pd.Series(None, index=data_frame.index, dtype=object)
+    reasons[data_frame["gene_id"].isna()] = "gene not found"
+    reasons[data_frame["repeat_id"] < 0] = f"repeat not found in {PANEL_NAME}"
+    data_frame["repeat_id"] = data_frame["repeat_id"].where(data_frame["repeat_id"] >= 0)
+
+    rejects_path = args.rejects or input_path + ".rejected.csv"
+    counts = bulk_upsert(engine, data_frame, CRCExprRepeatLenCorr.__table__, key=["repeat_id", "gene_id"],
+                         columns=CORRELATION_COLUMNS, batch_size=args.batch_size, rejects_path=rejects_path, reasons=reasons)
     logging.info(
         f"""
-            Inserted or updated {len(inserted_entities)} entities out of {input_csv_len}
+            Inserted or updated {counts['written']} entities out of {counts['read']}, rejected {counts['rejected']}
         """)
 
-    session.commit()
-
-    logging.info("Inserting gene expretion and repeat length correlation")
+    bump_data_version(engine, "import_crc_expr_repeatlength_corr")
 
 
 if __name__ == "__main__":
@@ -11,6 +11,7 @@ sys.path.append("..")
 
 from strAPI.repeats.models import Gene, Repeat, TRPanel, AlleleFrequency
 from gtf_to_sql import connection_setup
+from data_version import bump_data_version
 
 def cla_parser():
     parser = argparse.ArgumentParser()
@@ -184,6 +185,7 @@ def main():
                 print("Coulnd't find this repeat in db")
         
         session.commit()
+        bump_data_version(engine, "import_data_ensembltr")
  
 if __name__ == "__main__":
     main()
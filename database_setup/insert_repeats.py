@@ -3,13 +3,22 @@ import argparse
 import os
 import pickle
 import sys 
+from contextlib import nullcontext
 sys.path.append("..")
 
+import numpy as np
+from sqlalchemy.orm import selectinload
+
 from tral.repeat_list.repeat_list import RepeatList
 
-from strAPI.repeats.models import Gene, Repeat, TRPanel
+from strAPI.repeats.models import Gene, Repeat, TRPanel, GenesRepeatsLink, RepeatTranscriptsLink
 from gtf_to_sql import connection_setup
+from data_version import bump_data_version
+from bulk_load import BulkWriter, DEFAULT_BATCH_SIZE, next_id, sync_id_sequence
+from deferred_indexes import deferred_indexes
+from interval_join import overlap_pairs
 from strAPI.utils.constants import UPSTREAM, CHROMOSOME_LENGTHS
+from strAPI.utils.binning import region_to_bin
 
 def load_repeatlists(directory, targets=None):
     # collect all pickle files from input directory
@@ -49,16 +58,84 @@ def repeat_in_element(repeat, element, upstream=None):
         return True
     return False
 
-def make_db_repeat(repeat, score_type):
+def region_hits(repeat_starts, repeat_ends, region_starts, region_ends):
+    """ Vectorized repeat_in_element: does the repeat start or end within the region? """
+    return (((region_starts <= repeat_starts) & (repeat_starts <= region_ends)) |
+            ((region_starts <= repeat_ends) & (repeat_ends <= region_ends)))
+
+def gene_regions(genes, chrom, upstream=None):
+    """ Start and end arrays of genes on chromosome chrom, optionally extended with the
+    UPSTREAM region on the side of their transcription start
+    """
+    starts = np.array([gene.start for gene in genes], dtype=np.int64)
+    ends = np.array([gene.end for gene in genes], dtype=np.int64)
+    if upstream:
+        forward = np.array([gene.strand == "+" for gene in genes], dtype=bool)
+        starts = np.where(forward, np.maximum(starts - UPSTREAM, 1), starts)
+        ends = np.where(forward, ends, np.minimum(ends + UPSTREAM, CHROMOSOME_LENGTHS[chrom]))
+    return starts, ends
+
+def assign_repeats(repeats, genes, chrom):
+    """ Map all repeats of a chromosome to the genes and transcripts they lie in, using the same
+    criteria as repeat_in_element but with an interval join instead of comparing every repeat
+    against every gene
+
+    Parameters
+    repeats (List[Repeat]):  TRAL repeats on chromosome chrom
+    genes (List[Gene]):      Database genes on chromosome chrom, with their transcripts loaded
+
+    Returns
+    first_genes (List[Gene]):   For every repeat the first gene (in the order of genes) it maps to,
+                                including the upstream region, or None
+    transcripts (List[List[Transcript]]):
+                                For every repeat the transcripts of all genes it maps to that the
+                                repeat lies in
+    """
+    if not genes:
+        return [None] * len(repeats), [[] for _ in repeats]
+
+    repeat_starts = np.array([repeat.begin for repeat in repeats], dtype=np.int64)
+    repeat_ends = repeat_starts + np.array([repeat.repeat_region_length for repeat in repeats], dtype=np.int64) - 1
+
+    gene_starts, gene_ends = gene_regions(genes, chrom, upstream=UPSTREAM)
+    repeat_index, gene_index = overlap_pairs(repeat_starts, repeat_ends, gene_starts, gene_ends)
+    hit = region_hits(repeat_starts[repeat_index], repeat_ends[repeat_index], gene_starts[gene_index], gene_ends[gene_index])
+    repeat_index, gene_index = repeat_index[hit], gene_index[hit]
+
+    first_gene_index = np.full(len(repeats), len(genes), dtype=np.int64)
+    np.minimum.at(first_gene_index, repeat_index, gene_index)
+    first_genes = [genes[i] if i < len(genes) else None for i in first_gene_index.tolist()]
+
+    all_transcripts = [transcript for gene in genes for transcript in gene.transcripts]
+    transcript_genes = np.array([i for i, gene in enumerate(genes) for _ in gene.transcripts], dtype=np.int64)
+    transcript_starts = np.array([transcript.start for transcript in all_transcripts], dtype=np.int64)
+    transcript_ends = np.array([transcript.end for transcript in all_transcripts], dtype=np.int64)
+
+    pair_repeat, pair_transcript = overlap_pairs(repeat_starts, repeat_ends, transcript_starts, transcript_ends)
+    hit = region_hits(repeat_starts[pair_repeat], repeat_ends[pair_repeat], transcript_starts[pair_transcript], transcript_ends[pair_transcript])
+    pair_repeat, pair_transcript = pair_repeat[hit], pair_transcript[hit]
+    # only keep transcripts of genes the repeat was mapped to
+    in_gene = np.isin(pair_repeat * len(genes) + transcript_genes[pair_transcript], repeat_index * len(genes) + gene_index)
+
+    transcripts = [[] for _ in repeats]
+    for i, j in zip(pair_repeat[in_gene].tolist(), pair_transcript[in_gene].tolist()):
+        transcripts[i].append(all_transcripts[j])
+
+    return first_genes, transcripts
+
+def repeat_fields(repeat, score_type):
+    """ Column values of the database Repeat for a TRAL repeat
+    """
     if not hasattr(repeat, "TRD"):
         repeat.TRD = None
 
-    # initialize instance of database Repeat
-    db_repeat = Repeat(
+    end = repeat.begin + repeat.repeat_region_length - 1 # calculate end position
+    return dict(
         source = repeat.TRD,
         msa = ",".join(repeat.msa), # convert msa from list() to ',' separated str()
         start = repeat.begin,
-        end = repeat.begin + repeat.repeat_region_length - 1, # calculate end position
+        end = end,
+        bin = region_to_bin(repeat.begin, end),
         l_effective = repeat.l_effective,
         n_effective = repeat.n_effective,
         region_length = repeat.repeat_region_length,
@@ -68,6 +145,10 @@ def make_db_repeat(repeat, score_type):
         divergence = repeat.d_divergence[score_type]
     )
 
+def make_db_repeat(repeat, score_type):
+    # initialize instance of database Repeat
+    db_repeat = Repeat(**repeat_fields(repeat, score_type))
+
     return db_repeat
 
 def cla_parser():
@@ -82,10 +163,56 @@ def cla_parser():
     parser.add_argument(
         "--score_type", "-s", type=str, required=True, help="Which score type will be included in DB? options: phylo, phylo_gap01, phylo_gap001"
     )
+    parser.add_argument(
+        "--bulk", action="store_true", help="Stream repeats and their gene and transcript links into the DB in batches (COPY on PostgreSQL) instead of going through the ORM"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of repeats written per batch in bulk mode"
+    )
+    parser.add_argument(
+        "--files", "-f", type=str, nargs="+", help="Only insert the repeats of these pickle files (names without .pickle), e.g. chr21_repeats"
+    )
+    parser.add_argument(
+        "--defer_indexes", action="store_true", help="Drop the non-essential indexes of the repeats table before loading and rebuild them afterwards, see deferred_indexes.py"
+    )
 
     return parser.parse_args()
 
 
+def bulk_insert_repeats(engine, gene_dict, trpanel, input_path, score_type, batch_size=DEFAULT_BATCH_SIZE, targets=None):
+    """ Write repeats, genes_repeats and repeats_transcripts rows in batches without building ORM
+    objects. Repeat ids are assigned up front so the link rows can be written in the same batch
+    as the repeats they point to.
+    """
+    repeats_table = Repeat.__table__
+    genes_repeats_table = GenesRepeatsLink.__table__
+    repeats_transcripts_table = RepeatTranscriptsLink.__table__
+
+    with engine.connect() as connection:
+        repeat_id = next_id(connection, repeats_table)
+
+    tables = [repeats_table, genes_repeats_table, repeats_transcripts_table]
+    with BulkWriter(engine, tables, batch_size) as writer:
+        for file_name, repeat_list in load_repeatlists(input_path, targets):
+            print(f"Inserting repeats from file '{file_name}'")
+            repeat_chrom = file_name.split("_")[0]
+            first_genes, repeat_transcripts = assign_repeats(repeat_list.repeats, gene_dict.get(repeat_chrom, []), repeat_chrom)
+            for repeat, gene, transcripts in zip(repeat_list.repeats, first_genes, repeat_transcripts):
+                if gene is None:
+                    print(f"WARNING: repeat {repeat} could not be mapped to any of the genes in the database")
+                    continue
+
+                writer.add(repeats_table, dict(id = repeat_id, chr = repeat_chrom, trpanel_id = trpanel.id,
+                                               **repeat_fields(repeat, score_type)))
+                writer.add(genes_repeats_table, dict(repeat_id = repeat_id, gene_id = gene.id))
+                for transcript in transcripts:
+                    writer.add(repeats_transcripts_table, dict(repeat_id = repeat_id, transcript_id = transcript.id))
+                repeat_id += 1
+
+    with engine.begin() as connection:
+        sync_id_sequence(connection, repeats_table)
+    print(f"Inserted {writer.written[repeats_table.name]} repeats")
+
 def main():
     args = cla_parser()
     db_path = args.database
@@ -98,7 +225,7 @@ def main():
 
     # Collect all genes from DB into dictionary (chromosomes as keys)
     gene_dict = dict()
-    for gene in session.query(Gene).all():
+    for gene in session.query(Gene).options(selectinload(Gene.transcripts)).all():
         try:
             gene_dict[gene.chr].append(gene)
         except KeyError:
@@ -107,32 +234,34 @@ def main():
     trpanel = session.query(TRPanel).filter(TRPanel.name == 'gangstr_crc_hg38').one()
     print(trpanel)
 
-    for file_name, repeat_list in load_repeatlists(input_path):
+    with deferred_indexes(engine, [Repeat.__table__]) if args.defer_indexes else nullcontext():
+        if args.bulk:
+            bulk_insert_repeats(engine, gene_dict, trpanel, input_path, score_type, args.batch_size, args.files)
+        else:
+            insert_repeats(session, gene_dict, trpanel, input_path, score_type, args.files)
+    bump_data_version(engine, "insert_repeats")
+
+def insert_repeats(session, gene_dict, trpanel, input_path, score_type, targets=None):
+    """ Insert the repeats through the ORM """
+    for file_name, repeat_list in load_repeatlists(input_path, targets):
         print(f"Inserting repeats from file '{file_name}'")
         repeat_chrom = file_name.split("_")[0]
-        for repeat in repeat_list.repeats:
-            gene_count = 0            
-            for gene in gene_dict[repeat_chrom]:                
-                if repeat_in_element(repeat=repeat, element=gene, upstream=UPSTREAM):
-                    # The repeat could be mapped to a gene, check if this is the first 
-                    # time the repeat maps to a gene (gene_count == 1), if so: make DB entry for repeat
-                    gene_count += 1              
-                    if gene_count == 1:                       
-                        db_repeat = make_db_repeat(repeat, score_type)                                    
-                    
-                        # Add relationships to gene and tr panel 
-                        gene.repeats.append(db_repeat)
-
-                        db_repeat.trpanel_id = trpanel.id
-                        trpanel.repeats.append(db_repeat)
-                        
-
-                    for transcript in gene.transcripts:
-                        # Add repeat to all of the genes transcripts that it maps to
-                        if repeat_in_element(repeat=repeat, element=transcript):
-                            transcript.repeats.append(db_repeat)
-            if gene_count == 0:
+        first_genes, repeat_transcripts = assign_repeats(repeat_list.repeats, gene_dict.get(repeat_chrom, []), repeat_chrom)
+        for repeat, gene, transcripts in zip(repeat_list.repeats, first_genes, repeat_transcripts):
+            if gene is None:
                 print(f"WARNING: repeat {repeat} could not be mapped to any of the genes in the database")
+                continue
+
+            # The repeat is linked to the first gene it maps to and to the transcripts
+            # of all the genes it maps to
+            db_repeat = make_db_repeat(repeat, score_type)
+            gene.repeats.append(db_repeat)
+
+            db_repeat.trpanel_id = trpanel.id
+            trpanel.repeats.append(db_repeat)
+
+            for transcript in transcripts:
+                transcript.repeats.append(db_repeat)
     session.commit()
 
 if __name__ == "__main__":
@@ -1,40 +1,22 @@
 #!/usr/bin/env python3
+""" Load locus level CRC variation stats, keeping the stats of repeats that already have them
+
+Use update_repeats.py to replace existing stats instead. Rows whose repeat_id is not in the
+repeats table are written to the rejects file.
+
+Example
+python insert_variations.py -d sqlite:///../db/debug.db -v ../data/20220527_locus_variation_no_groups.csv
+"""
 import argparse
+from contextlib import nullcontext
 from gtf_to_sql import connection_setup
+from data_version import bump_data_version
+from bulk_load import DEFAULT_BATCH_SIZE
+from update_repeats import upsert_variations
+from strAPI.repeats.models import CRCVariation
+from deferred_indexes import deferred_indexes
 import pandas as pd
 
-from repeats.models import CRCVariation, Repeat
-
-def make_db_variation(df_row, session):
-    try:
-        var_already_in_db = session.query(CRCVariation).filter_by(
-            tcga_barcode = df_row["patient"],
-            sample_type = df_row["sample_type"],
-            start = df_row['start'],
-            end = df_row['end']).one()
-        return "Already exists in the database"
-    except:
-        # initialize instance of database CRCVariation
-        db_variation = CRCVariation(
-            tcga_barcode = df_row["patient"],
-            sample_type = df_row["sample_type"],
-            start = df_row['start'],
-            end = df_row['end'],
-            reference = df_row["ref"],
-            alt = df_row["alt"],
-            repeat_id = df_row["repeat_id"]
-        )
-
-        #try:
-        repeat_id = df_row["repeat_id"]
-        print(repeat_id)
-        if repeat_id != '.':
-            repeat = session.query(Repeat).get(int(repeat_id))
-            repeat.crcvariations.append(db_variation)
-        #except:
-        #    print("This might be a PERF repeat, " + df_row["repeat_id"])
-        return True
-
 def cla_parser():
     parser = argparse.ArgumentParser()
 
@@ -44,24 +26,37 @@ def cla_parser():
     parser.add_argument(
         "--var", "-v", type=str, required=True, help="Path to variations file in csv format"
     )
-  
+    parser.add_argument(
+        "--rejects", "-r", type=str, help="CSV file for rows that could not be loaded, defaults to the input path with .rejected.csv appended"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of rows written per statement"
+    )
+    parser.add_argument(
+        "--defer_indexes", action="store_true", help="Drop the non-essential indexes of the crcvariations table before loading and rebuild them afterwards, see deferred_indexes.py"
+    )
+
     return parser.parse_args()
 
 
 def main():
     args = cla_parser()
     db_path = args.database
-    db_path = db_path.replace("postgres://", "postgresql+psycopg2://") 
+    db_path = db_path.replace("postgres://", "postgresql+psycopg2://")
 
     input_path = args.var
+    rejects_path = args.rejects or input_path + ".rejected.csv"
     print("Connecting to the database")
     engine, session = connection_setup(db_path)
 
-    df_var = pd.read_csv(input_path)
+    df_var = pd.read_csv(input_path, dtype=str, keep_default_na=False)
+
+    with deferred_indexes(engine, [CRCVariation.__table__]) if args.defer_indexes else nullcontext():
+        counts = upsert_variations(engine, df_var, update=False, batch_size=args.batch_size, rejects_path=rejects_path)
+    print(f"Read {counts['read']} rows, inserted {counts['written']}, rejected {counts['rejected']}"
+          + (f" (see {rejects_path})" if counts["rejected"] else ""))
 
-    df_var.apply(lambda row : make_db_variation(row, session), axis = 1)
-  
-    session.commit()
+    bump_data_version(engine, "insert_variations")
 
 if __name__ == "__main__":
     main()
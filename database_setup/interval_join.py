@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+""" Vectorized interval join between two sets of intervals on the same chromosome
+
+Reference intervals are sorted by start once, after which the candidates of every query are
+found with a binary search instead of comparing each query against every reference interval.
+"""
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 20000
+
+def overlap_pairs(query_starts, query_ends, ref_starts, ref_ends, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Find all overlapping (query, reference) pairs, coordinates are 1-based and inclusive
+
+    Parameters
+    query_starts, query_ends (array-like):  Coordinates of the query intervals
+    ref_starts, ref_ends (array-like):      Coordinates of the reference intervals, in any order
+    chunk_size (int):                       Number of queries joined at once, bounds memory use
+
+    Returns
+    Tuple of (query index, reference index) arrays, sorted by query index and then by
+    reference start
+    """
+    query_starts = np.asarray(query_starts, dtype=np.int64)
+    query_ends = np.asarray(query_ends, dtype=np.int64)
+    ref_starts = np.asarray(ref_starts, dtype=np.int64)
+    ref_ends = np.asarray(ref_ends, dtype=np.int64)
+
+    if len(query_starts) == 0 or len(ref_starts) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    order = np.argsort(ref_starts, kind="stable")
+    sorted_starts = ref_starts[order]
+    # An overlapping reference can't start further left of the query than the longest reference
+    max_length = int((ref_ends - ref_starts).max())
+
+    query_indices, ref_indices = [], []
+    for chunk_start in range(0, len(query_starts), chunk_size):
+        starts = query_starts[chunk_start:chunk_start + chunk_size]
+        ends = query_ends[chunk_start:chunk_start + chunk_size]
+
+        lo = np.searchsorted(sorted_starts, starts - max_length, side="left")
+        hi = np.searchsorted(sorted_starts, ends, side="right")
+        counts = hi - lo
+
+        query_index = np.repeat(np.arange(len(starts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        ref_index = order[np.repeat(lo, counts) + offsets]
+
+        keep = ref_ends[ref_index] >= starts[query_index]
+        query_indices.append(query_index[keep] + chunk_start)
+        ref_indices.append(ref_index[keep])
+
+    return np.concatenate(query_indices), np.concatenate(ref_indices)
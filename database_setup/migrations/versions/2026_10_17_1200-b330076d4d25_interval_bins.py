@@ -0,0 +1,54 @@
+"""interval bins for region queries on repeats and genes
+
+Revision ID: b330076d4d25
+Revises: 09734b51018c
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b330076d4d25'
+down_revision = '09734b51018c'
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# UCSC binning scheme, kept in sync with strAPI/utils/binning.py
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+
+def bin_expression(table):
+    """ SQL expression computing the UCSC bin of every row from its 1-based start and end
+    """
+    start = sa.column('start', sa.Integer)
+    end = sa.column('end', sa.Integer)
+    whens = []
+    shift = BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        size = 2 ** shift
+        whens.append(((start - 1) / size == (end - 1) / size, offset + (start - 1) / size))
+        shift += BIN_NEXT_SHIFT
+    return sa.update(sa.table(table, start, end, sa.column('bin', sa.Integer))).values(bin=sa.case(*whens))
+
+
+def upgrade():
+    for table in ('repeats', 'genes'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('bin', sa.Integer(), nullable=True))
+
+        op.execute(bin_expression(table))
+
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.create_index(batch_op.f(f'ix_{table}_bin'), ['bin'], unique=False)
+            batch_op.create_index(f'ix_{table}_chr_bin_start', ['chr', 'bin', 'start'], unique=False)
+
+
+def downgrade():
+    for table in ('genes', 'repeats'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_index(f'ix_{table}_chr_bin_start')
+            batch_op.drop_index(batch_op.f(f'ix_{table}_bin'))
+            batch_op.drop_column('bin')
@@ -0,0 +1,45 @@
+"""dataset version bumped by the loaders
+
+Revision ID: 5c1e2a7f9b3d
+Revises: b330076d4d25
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c1e2a7f9b3d'
+down_revision = 'b330076d4d25'
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+def upgrade():
+    dataset_version = op.create_table('dataset_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.Column('source', sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('dataset_version', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_dataset_version_id'), ['id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_dataset_version_source'), ['source'], unique=False)
+        batch_op.create_index(batch_op.f('ix_dataset_version_updated_at'), ['updated_at'], unique=False)
+        batch_op.create_index(batch_op.f('ix_dataset_version_version'), ['version'], unique=False)
+
+    # Existing data counts as the first version
+    op.bulk_insert(dataset_version, [{'id': 1, 'version': 1, 'updated_at': datetime.utcnow(), 'source': 'migration'}])
+
+
+def downgrade():
+    with op.batch_alter_table('dataset_version', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_dataset_version_version'))
+        batch_op.drop_index(batch_op.f('ix_dataset_version_updated_at'))
+        batch_op.drop_index(batch_op.f('ix_dataset_version_source'))
+        batch_op.drop_index(batch_op.f('ix_dataset_version_id'))
+
+    op.drop_table('dataset_version')
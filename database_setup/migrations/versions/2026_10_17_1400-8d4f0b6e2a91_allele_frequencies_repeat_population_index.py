@@ -0,0 +1,25 @@
+"""composite index on allele_frequencies (repeat_id, population)
+
+Revision ID: 8d4f0b6e2a91
+Revises: 5c1e2a7f9b3d
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d4f0b6e2a91'
+down_revision = '5c1e2a7f9b3d'
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+def upgrade():
+    with op.batch_alter_table('allele_frequencies', schema=None) as batch_op:
+        batch_op.create_index('ix_allele_frequencies_repeat_id_population', ['repeat_id', 'population'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('allele_frequencies', schema=None) as batch_op:
+        batch_op.drop_index('ix_allele_frequencies_repeat_id_population')
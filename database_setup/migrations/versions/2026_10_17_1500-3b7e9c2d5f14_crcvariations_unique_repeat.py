@@ -0,0 +1,29 @@
+"""unique crcvariations.repeat_id, conflict target of the bulk upserts
+
+Revision ID: 3b7e9c2d5f14
+Revises: 8d4f0b6e2a91
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b7e9c2d5f14'
+down_revision = '8d4f0b6e2a91'
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+def upgrade():
+    # A repeat has one set of CRC variation stats, keep the latest row of repeats that have several
+    op.execute(
+        "DELETE FROM crcvariations WHERE id NOT IN (SELECT MAX(id) FROM crcvariations GROUP BY repeat_id)"
+    )
+    with op.batch_alter_table('crcvariations', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_crcvariations_repeat_id', ['repeat_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('crcvariations', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_crcvariations_repeat_id', type_='unique')
@@ -0,0 +1,35 @@
+"""etl checkpoints written by database_setup/etl.py
+
+Revision ID: 6a2f8e4c1d07
+Revises: 3b7e9c2d5f14
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a2f8e4c1d07'
+down_revision = '3b7e9c2d5f14'
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+def upgrade():
+    # etl.py creates the table itself when it builds a database, which may be before this runs
+    if sa.inspect(op.get_bind()).has_table('etl_checkpoints'):
+        return
+    op.create_table('etl_checkpoints',
+    sa.Column('stage', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('chunk', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('status', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('rows', sa.Integer(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('error', sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    sa.PrimaryKeyConstraint('stage', 'chunk')
+    )
+
+
+def downgrade():
+    op.drop_table('etl_checkpoints')
@@ -1,6 +1,19 @@
 #!/usr/bin/env python3
+""" Load the CRC variation stats of repeats, replacing the stats of repeats that already have them
+
+Rows whose repeat_id is not in the repeats table (e.g. '.' for PERF repeats) are written to the
+rejects file instead of being loaded.
+
+Example
+python update_repeats.py -d sqlite:///../db/debug.db -v ../data/20220527_locus_variation_no_groups.csv
+"""
 import argparse
+from contextlib import nullcontext
 from gtf_to_sql import connection_setup
+from data_version import bump_data_version
+from bulk_load import DEFAULT_BATCH_SIZE
+from bulk_upsert import bulk_upsert
+from deferred_indexes import deferred_indexes
 import pandas as pd
 import sys
 
@@ -8,25 +21,21 @@ sys.path.append("..")
 
 from strAPI.repeats.models import Repeat, CRCVariation
 
-def update_db_variation(df_row, session):
-        try:
-            repeat_id = df_row["repeat_id"]
-           
-            if repeat_id != '.':
-                repeat = session.query(Repeat).get(int(repeat_id))
-                db_variation = CRCVariation(
-                    instable_calls = df_row["instable_calls"],
-                    stable_calls = df_row["stable_calls"],
-                    total_calls = df_row["total_calls"],
-                    frac_variable = df_row["frac_variable"],
-                    avg_size_diff = df_row["avg_size_diff"],
-                    repeat_id = repeat_id
-                )
-                repeat.crcvariation = db_variation
-        except:
-            print("This might be a PERF repeat ")
-            print(df_row)
-        return True
+CRC_VARIATION_COLUMNS = ["repeat_id", "instable_calls", "stable_calls", "total_calls", "frac_variable", "avg_size_diff"]
+
+def upsert_variations(engine, df_var, update, batch_size=DEFAULT_BATCH_SIZE, rejects_path=None):
+    """ Write the CRC variation stats in df_var, one row per repeat
+
+    Parameters
+    engine:             Engine of the database to load into
+    df_var (DataFrame): Stats with a column per entry of CRC_VARIATION_COLUMNS
+    update (bool):      Replace the stats of repeats that already have them, else keep those
+    """
+    return bulk_upsert(
+        engine, df_var, CRCVariation.__table__, key=["repeat_id"], columns=CRC_VARIATION_COLUMNS,
+        references={"repeat_id": Repeat.__table__.c.id}, update=update, batch_size=batch_size,
+        rejects_path=rejects_path,
+    )
 
 def cla_parser():
     parser = argparse.ArgumentParser()
@@ -37,24 +46,37 @@ def cla_parser():
     parser.add_argument(
         "--var", "-v", type=str, required=True, help="Path to repeats file in csv format"
     )
-  
+    parser.add_argument(
+        "--rejects", "-r", type=str, help="CSV file for rows that could not be loaded, defaults to the input path with .rejected.csv appended"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of rows written per statement"
+    )
+    parser.add_argument(
+        "--defer_indexes", action="store_true", help="Drop the non-essential indexes of the crcvariations table before loading and rebuild them afterwards, see deferred_indexes.py"
+    )
+
     return parser.parse_args()
 
 
 def main():
     args = cla_parser()
     db_path = args.database
-    db_path = db_path.replace("postgres://", "postgresql+psycopg2://") 
-    
+    db_path = db_path.replace("postgres://", "postgresql+psycopg2://")
+
     input_path = args.var
+    rejects_path = args.rejects or input_path + ".rejected.csv"
     print("Connecting to the database")
     engine, session = connection_setup(db_path)
 
-    df_var = pd.read_csv(input_path)
+    df_var = pd.read_csv(input_path, dtype=str, keep_default_na=False)
+
+    with deferred_indexes(engine, [CRCVariation.__table__]) if args.defer_indexes else nullcontext():
+        counts = upsert_variations(engine, df_var, update=True, batch_size=args.batch_size, rejects_path=rejects_path)
+    print(f"Read {counts['read']} rows, wrote {counts['written']}, rejected {counts['rejected']}"
+          + (f" (see {rejects_path})" if counts["rejected"] else ""))
 
-    df_var.apply(lambda row : update_db_variation(row, session), axis = 1)
-  
-    session.commit()
+    bump_data_version(engine, "update_repeats")
 
 if __name__ == "__main__":
     main()
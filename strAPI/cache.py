@@ -0,0 +1,163 @@
+""" Caches for read-mostly lookups (panel names, genes by name or Ensembl id, /repeatinfo payloads)
+
+Every cache holds at most WEBSTR_CACHE_SIZE entries, evicting the least recently used ones, and
+entries expire after WEBSTR_CACHE_TTL seconds. Keys are built from the endpoint and its normalized
+query parameters. All entries are dropped when the dataset version (models.DatasetVersion, bumped
+by the database_setup loaders) changes, which is checked at most every
+WEBSTR_DATA_VERSION_CHECK_INTERVAL seconds.
+
+With WEBSTR_CACHE_URL set to a redis:// URL the entries are kept in Redis instead (this needs the
+redis package, not installed by default), so they are shared by all API processes. Their keys
+include the dataset version, so no explicit invalidation is needed there. Values must be JSON
+serializable.
+
+Caching is enabled with WEBSTR_CACHE_ENABLE=1. Hits and misses are counted in /metrics.
+"""
+import collections
+import json
+import os
+import threading
+import time
+
+from sqlmodel import select
+
+from . import metrics
+from .repeats.models import DatasetVersion
+
+CACHE_ENABLED = os.environ.get("WEBSTR_CACHE_ENABLE", "") == "1"
+CACHE_SIZE = int(os.environ.get("WEBSTR_CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.environ.get("WEBSTR_CACHE_TTL", "3600"))
+CACHE_URL = os.environ.get("WEBSTR_CACHE_URL", "")
+DATA_VERSION_CHECK_INTERVAL = float(os.environ.get("WEBSTR_DATA_VERSION_CHECK_INTERVAL", "30"))
+
+_MISSING = object()
+
+def cache_key(endpoint, **params):
+    """ Key for endpoint and its query parameters: lists are deduplicated and sorted and
+    parameters that are not given are left out, so equivalent queries share an entry
+    """
+    normalized = dict()
+    for name, value in params.items():
+        if value is None or value == []:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            value = sorted(set(value))
+        normalized[name] = value
+    return f"{endpoint}:{json.dumps(normalized, sort_keys=True, default=str)}"
+
+class LRUCache(object):
+    """ In-process cache bounded to maxsize entries, each expiring ttl seconds after it was stored """
+    def __init__(self, name, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return _MISSING
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return _MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, version, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class RedisCache(object):
+    """ Cache shared between processes through Redis (or anything speaking its protocol), with
+    entries serialized as JSON. Redis enforces the TTL, its maxmemory policy bounds the size
+    """
+    def __init__(self, name, url=CACHE_URL, ttl=CACHE_TTL):
+        import redis
+        self.name = name
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url)
+
+    def redis_key(self, key, version):
+        return f"webstr:{self.name}:{version}:{key}"
+
+    def get(self, key, version):
+        data = self.client.get(self.redis_key(key, version))
+        return _MISSING if data is None else json.loads(data)
+
+    def set(self, key, version, value):
+        self.client.set(self.redis_key(key, version), json.dumps(value, default=str), ex=int(self.ttl))
+
+    def clear(self):
+        pass
+
+class DataVersion(object):
+    """ Dataset version and the time it was loaded (updated_at) as last read from the database,
+    re-read at most every check_interval seconds
+    """
+    def __init__(self, check_interval=DATA_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.version = None
+        self.updated_at = None
+        self.checked_at = None
+
+    def statement(self):
+        return select(DatasetVersion.version, DatasetVersion.updated_at).where(DatasetVersion.id == 1)
+
+    def due(self):
+        return self.checked_at is None or time.monotonic() - self.checked_at >= self.check_interval
+
+    def update(self, row):
+        self.checked_at = time.monotonic()
+        version, updated_at = row if row is not None else (None, None)
+        self.updated_at = updated_at
+        if version != self.version:
+            self.version = version
+            for cache in _caches:
+                cache.clear()
+
+    async def current(self, db):
+        if self.due():
+            self.update((await db.exec(self.statement())).first())
+        return self.version
+
+_caches = []
+data_version = DataVersion()
+
+def make_cache(name):
+    cache = RedisCache(name) if CACHE_URL else LRUCache(name)
+    _caches.append(cache)
+    return cache
+
+async def cached(cache, key, db, compute):
+    """ Value of key in cache, computed by awaiting compute() and stored on a miss
+
+    Parameters
+    cache:      Cache from make_cache
+    key (str):  Key from cache_key
+    db:         Async session, used to check the dataset version
+    compute:    Coroutine function returning the value, called without arguments
+    """
+    if not CACHE_ENABLED:
+        return await compute()
+
+    version = await data_version.current(db)
+    value = cache.get(key, version)
+    metrics.record_cache(cache.name, value is not _MISSING)
+    if value is _MISSING:
+        value = await compute()
+        cache.set(key, version, value)
+    return value
+
+panel_names = make_cache("panel_names")
+genes = make_cache("genes")
+repeat_info = make_cache("repeat_info")
@@ -0,0 +1,168 @@
+""" Content-negotiated gzip and brotli compression of responses
+
+CompressionMiddleware compresses JSON and text (csv, tsv) responses with the best coding the
+client accepts, brotli before gzip. Streamed responses such as the csv downloads are compressed
+chunk by chunk, every chunk being flushed so the client receives rows as they are produced and
+the response is never buffered as a whole. Responses that are already encoded (the downloads
+with compress=true), binary formats (arrow, parquet) and complete bodies smaller than
+WEBSTR_COMPRESSION_MIN_SIZE bytes are sent unchanged.
+
+The coding is appended to the ETag set by http_cache.py (e.g. "v3-...-br"), as the compressed
+bytes are a different representation, and removed again from If-None-Match on the way in.
+Set WEBSTR_COMPRESSION_ENABLE=0 to turn compression off, e.g. when a proxy in front compresses.
+"""
+import os
+import re
+import zlib
+
+import brotli
+
+COMPRESSION_ENABLED = os.environ.get("WEBSTR_COMPRESSION_ENABLE", "1") == "1"
+COMPRESSION_MIN_SIZE = int(os.environ.get("WEBSTR_COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.environ.get("WEBSTR_GZIP_LEVEL", "6"))
+# Qualities above 5 cost much more CPU for little gain on data compressed per request
+BROTLI_QUALITY = int(os.environ.get("WEBSTR_BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+# Codings in order of preference when the client accepts several with the same quality
+CODINGS = ("br", "gzip")
+
+ETAG_CODING_SUFFIX = re.compile(r'-(?:br|gzip)"')
+
+class GzipEncoder(object):
+    def __init__(self, level=GZIP_LEVEL):
+        # wbits 31: gzip header and trailer instead of the zlib ones
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def encode(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=b""):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_FINISH)
+
+class BrotliEncoder(object):
+    def __init__(self, quality=BROTLI_QUALITY):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def encode(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self, data=b""):
+        return self.compressor.process(data) + self.compressor.finish()
+
+ENCODERS = {"br": BrotliEncoder, "gzip": GzipEncoder}
+
+def negotiate(accept_encoding):
+    """ Coding from CODINGS to use given the Accept-Encoding header, None if the client accepts none
+
+    Parameters
+    accept_encoding (str): Header value, e.g. "gzip, deflate, br;q=0.9"
+    """
+    qualities = dict()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+
+    best, best_quality = None, 0.0
+    for coding in CODINGS:
+        quality = qualities.get(coding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+def add_vary(headers):
+    """ headers with Accept-Encoding added to Vary, so that caches keep one copy per coding """
+    vary = [value.decode("latin-1") for name, value in headers if name == b"vary"]
+    headers = [(name, value) for name, value in headers if name != b"vary"]
+    values = [v.strip() for value in vary for v in value.split(",") if v.strip()]
+    if "accept-encoding" not in (v.lower() for v in values):
+        values.append("Accept-Encoding")
+    return headers + [(b"vary", ", ".join(values).encode("latin-1"))]
+
+def tag_etag(headers, coding):
+    return [(name, value[:-1] + f'-{coding}"'.encode("latin-1") if name == b"etag" and value.endswith(b'"') else value)
+            for name, value in headers]
+
+class CompressionMiddleware(object):
+    """ ASGI middleware compressing response bodies with the coding negotiated from Accept-Encoding """
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if not COMPRESSION_ENABLED or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        coding = None
+        headers = []
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                coding = negotiate(value.decode("latin-1"))
+            elif name == b"if-none-match":
+                value = ETAG_CODING_SUFFIX.sub('"', value.decode("latin-1")).encode("latin-1")
+            headers.append((name, value))
+        scope = {**scope, "headers": headers}
+
+        start = None
+        encoder = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, encoder, passthrough
+            if message["type"] == "http.response.start":
+                response_headers = list(message.get("headers", []))
+                if message["status"] == 304:
+                    passthrough = True
+                    if coding is not None:
+                        message = {**message, "headers": add_vary(tag_etag(response_headers, coding))}
+                    await send(message)
+                    return
+                content_type = dict(response_headers).get(b"content-type", b"").decode("latin-1")
+                if (coding is None or b"content-encoding" in dict(response_headers)
+                        or not content_type.startswith(COMPRESSIBLE_TYPES)):
+                    passthrough = True
+                    if content_type.startswith(COMPRESSIBLE_TYPES):
+                        message = {**message, "headers": add_vary(response_headers)}
+                    await send(message)
+                    return
+                # Wait for the first body chunk to decide whether compression is worth it
+                start = {**message, "headers": response_headers}
+                return
+
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                response_headers = add_vary(start["headers"])
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send({**start, "headers": response_headers})
+                    await send(message)
+                    return
+                response_headers = [(name, value) for name, value in tag_etag(response_headers, coding)
+                                    if name != b"content-length"]
+                response_headers.append((b"content-encoding", coding.encode("latin-1")))
+                await send({**start, "headers": response_headers})
+                start = None
+                encoder = ENCODERS[coding]()
+
+            data = encoder.encode(body) if more_body else encoder.finish(body)
+            if data or not more_body:
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,208 @@
+import csv
+import io
+import json
+import zlib
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fastapi.responses import StreamingResponse
+
+# Number of rows fetched from the database cursor and written per chunk
+CHUNK_ROWS = 1000
+
+DELIMITERS = {"csv": ",", "tsv": "\t"}
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "tsv": "text/tab-separated-values",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+    "ndjson": "application/x-ndjson",
+}
+# Values accepted by the format parameter of the endpoints
+FORMAT_REGEX = "^(csv|tsv|arrow|parquet)$"
+
+def streaming_options(statement):
+    """ Fetch the rows of statement from a server-side cursor, CHUNK_ROWS at a time, instead of
+    loading the whole result before the first row is sent
+    """
+    return statement.execution_options(stream_results=True, yield_per=CHUNK_ROWS)
+
+class DelimitedEncoder(object):
+    """ Encodes batches of dict rows as delimited text, optionally gzip compressed on the fly
+
+    Parameters
+    headers (List[str]):Column names, in output order
+    delimiter (str):    Field separator
+    compress (bool):    Whether to gzip the output
+    """
+    def __init__(self, headers, delimiter=",", compress=False):
+        self.compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+        self.buffer = io.StringIO()
+        self.writer = csv.DictWriter(self.buffer, headers, delimiter=delimiter, extrasaction="ignore")
+        self.writer.writeheader()
+
+    def take(self):
+        data = self.buffer.getvalue().encode("utf-8")
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return self.compressor.compress(data) if self.compressor else data
+
+    def encode(self, rows):
+        self.writer.writerows(rows)
+        return self.take()
+
+    def finish(self):
+        data = self.take()
+        return data + self.compressor.flush() if self.compressor else data
+
+def batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == CHUNK_ROWS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def async_batches(rows):
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) == CHUNK_ROWS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def encoded_chunks(encoder, rows):
+    """ Yield the non-empty chunks of encoder's output for rows, CHUNK_ROWS rows at a time """
+    for batch in batches(rows):
+        chunk = encoder.encode(batch)
+        if chunk:
+            yield chunk
+    chunk = encoder.finish()
+    if chunk:
+        yield chunk
+
+async def async_encoded_chunks(encoder, rows):
+    """ encoded_chunks for rows coming from an async iterator, e.g. an AsyncResult """
+    async for batch in async_batches(rows):
+        chunk = encoder.encode(batch)
+        if chunk:
+            yield chunk
+    chunk = encoder.finish()
+    if chunk:
+        yield chunk
+
+def stream_content(encoder, rows):
+    if hasattr(rows, "__aiter__"):
+        return async_encoded_chunks(encoder, rows)
+    return encoded_chunks(encoder, rows)
+
+def delimited_response(rows, headers, name, output_format="csv", compress=False):
+    """ StreamingResponse downloading rows as a csv or tsv file named name, gzipped if compress
+    """
+    filename = f"{name}.{output_format}" + (".gz" if compress else "")
+    media_type = "application/gzip" if compress else MEDIA_TYPES[output_format]
+    return StreamingResponse(
+        stream_content(DelimitedEncoder(headers, DELIMITERS[output_format], compress), rows),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+class NDJSONEncoder(object):
+    """ Encodes batches of dict rows as newline delimited JSON, one object per line """
+    def encode(self, rows):
+        return "".join(json.dumps(row, default=str) + "\n" for row in rows).encode("utf-8")
+
+    def finish(self):
+        return b""
+
+def ndjson_response(rows):
+    """ StreamingResponse with one JSON object per row, sent CHUNK_ROWS rows at a time """
+    return StreamingResponse(stream_content(NDJSONEncoder(), rows), media_type=MEDIA_TYPES["ndjson"])
+
+class ChunkSink(io.RawIOBase):
+    """ Write-only file that hands out what was written since the last take(), while reporting
+    the total number of bytes written as its position, as the parquet writer expects
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+class ColumnarEncoder(object):
+    """ Encodes batches of dict rows as an Arrow IPC stream or a Parquet file, one record batch
+    (row group for Parquet) per batch
+
+    Parameters
+    schema (pa.Schema):     Columns and their types
+    output_format (str):    'arrow' or 'parquet'
+    compress (bool):        Compress Arrow buffers with zstd, Parquet is always snappy compressed
+    """
+    def __init__(self, schema, output_format="arrow", compress=False):
+        self.schema = schema
+        self.output_format = output_format
+        self.sink = ChunkSink()
+        if output_format == "arrow":
+            options = pa.ipc.IpcWriteOptions(compression="zstd" if compress else None)
+            self.writer = pa.ipc.new_stream(self.sink, schema, options=options)
+        else:
+            self.writer = pq.ParquetWriter(self.sink, schema)
+
+    def encode(self, rows):
+        batch = pa.RecordBatch.from_pylist(rows, schema=self.schema)
+        if self.output_format == "arrow":
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        return self.sink.take()
+
+    def finish(self):
+        self.writer.close()
+        return self.sink.take()
+
+def arrow_schema(columns):
+    """ pa.Schema from a list of (column name, arrow type name) pairs """
+    return pa.schema([(name, pa.type_for_alias(type_name)) for name, type_name in columns])
+
+def columnar_response(rows, columns, name, output_format="arrow", compress=False):
+    """ StreamingResponse downloading rows as an Arrow stream or Parquet file named name
+
+    columns is a list of (column name, arrow type name) pairs, e.g. ("start", "int64")
+    """
+    extension = "arrows" if output_format == "arrow" else "parquet"
+    return StreamingResponse(
+        stream_content(ColumnarEncoder(arrow_schema(columns), output_format, compress), rows),
+        media_type=MEDIA_TYPES[output_format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{extension}"'}
+    )
+
+def export_response(rows, columns, name, output_format, compress=False, headers=None):
+    """ Download rows in output_format (csv, tsv, arrow or parquet)
+
+    Parameters
+    rows:                   Iterable or async iterable of dicts keyed by column name
+    columns:                List of (column name, arrow type name) pairs
+    name (str):             File name without extension
+    headers (List[str]):    Header of csv and tsv files if it differs from the column names
+    """
+    if output_format in DELIMITERS:
+        return delimited_response(rows, headers or [column for column, _ in columns], name, output_format, compress)
+    return columnar_response(rows, columns, name, output_format, compress)
@@ -1,4 +1,8 @@
+from sqlalchemy.orm import selectinload
+from sqlmodel import select
+
 from . repeats.models import Gene, Transcript
+from . utils.binning import bin_filter
 
 GENEBUFFER = 0.1
 
@@ -14,33 +18,53 @@ def get_exons_by_transcript(db, cds_only, transcript_obj):
     elif transcript_obj.gene.strand == "-":
         return list(sorted(exons, key=lambda x : x.start, reverse=True))
 
-def get_gene_info(db, gene_names, ensembl_ids, reqion_query):
-    genes = []
+def parse_region(region_query):
+    """ Parse a region query of the form '1:182393-1014541' into (chrom, start, end)
+    """
+    region_split = region_query.split(':')
+    chrom = 'chr' + region_split[0]
+    coord_split = region_split[1].split('-')
+    start = int(coord_split[0])
+    end = int(coord_split[1])
+    return chrom, start, end
+
+def gene_info_statement(gene_names, ensembl_ids, reqion_query):
+    """ Select statement for the genes with the given names, else ensembl ids, else in the given
+    region (widened by GENEBUFFER on both sides), None if no query is given
+    """
     if gene_names:
-        genes = db.query(Gene).filter(Gene.name.in_(gene_names)).all()
+        return select(Gene).where(Gene.name.in_(gene_names))
     elif ensembl_ids:
-        genes =  db.query(Gene).filter(Gene.ensembl_id.in_(ensembl_ids)).all()  
+        return select(Gene).where(Gene.ensembl_id.in_(ensembl_ids))
     # Example chr1:182393-1014541
-  
     elif reqion_query: 
-        region_split = reqion_query.split(':')
-        chrom = 'chr' + region_split[0]
-        coord_split = region_split[1].split('-')
-        start = int(coord_split[0])
-        end = int(coord_split[1])
+        chrom, start, end = parse_region(reqion_query)
         buf = int((end-start)*(GENEBUFFER))
         start = start-buf
         end = end+buf
    
-        genes = db.query(Gene).where(Gene.chr == chrom,Gene.start >= start,Gene.end <= end).all()
-    
-    return genes
+        return select(Gene).where(Gene.chr == chrom, bin_filter(Gene.bin, start, end),
+                                  Gene.start >= start, Gene.end <= end)
+    return None
+
+async def get_gene_info(db, gene_names, ensembl_ids, reqion_query):
+    statement = gene_info_statement(gene_names, ensembl_ids, reqion_query)
+    if statement is None:
+        return []
+    return (await db.exec(statement)).all()
+
+def first_transcript_statement(gene):
+    """ First transcript of gene with its exons and gene loaded up front, as lazy loading is not
+    available in async sessions
+    """
+    return select(Transcript).where(Transcript.gene_id == gene.id
+        ).options(selectinload(Transcript.exons), selectinload(Transcript.gene)).limit(1)
 
-def get_genes_with_exons(db, genes):
+async def get_genes_with_exons(db, genes):
     genes_exons = []
     # TODO: change to for each transcript in transcripts...., right now only returns the first
     for gene in iter(genes):
-        transcript = db.query(Transcript).filter_by(gene_id=gene.id).first()
+        transcript = (await db.exec(first_transcript_statement(gene))).first()
         exons_obj = get_exons_by_transcript(db, True, transcript)
         exons = []
         for exon in iter(exons_obj):
@@ -0,0 +1,120 @@
+""" HTTP caching of the read endpoints whose data only changes when the database_setup loaders run
+
+HTTPCacheMiddleware adds a strong ETag, Last-Modified and Cache-Control to successful GET
+responses of CACHEABLE_PATHS. The ETag is derived from the dataset version (models.DatasetVersion,
+bumped by the loaders) and the normalized query, so it changes with every load and is known before
+the endpoint runs. Conditional requests (If-None-Match, or If-Modified-Since without it) that still
+match are answered with 304 Not Modified without calling the endpoint, so the repeat tables are not
+queried at all. The dataset version is shared with cache.py and re-read at most every
+WEBSTR_DATA_VERSION_CHECK_INTERVAL seconds.
+
+Responses may be kept by browsers and CDNs for WEBSTR_HTTP_CACHE_MAX_AGE seconds before they are
+revalidated. Set WEBSTR_HTTP_CACHE_ENABLE=0 to turn the headers off.
+"""
+import hashlib
+import logging
+import os
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import parse_qsl, urlencode
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from .cache import data_version
+from .repeats.database import async_read_session
+
+logger = logging.getLogger(__name__)
+
+HTTP_CACHE_ENABLED = os.environ.get("WEBSTR_HTTP_CACHE_ENABLE", "1") == "1"
+HTTP_CACHE_MAX_AGE = int(os.environ.get("WEBSTR_HTTP_CACHE_MAX_AGE", "300"))
+
+CACHEABLE_PATHS = {"/repeats", "/allfreqs", "/genefeatures", "/crc_expr_repeatlen_corr"}
+
+def normalized_query(query_string):
+    """ Query string with its parameters sorted, so that the order they were given in does not matter """
+    return urlencode(sorted(parse_qsl(query_string.decode("latin-1"), keep_blank_values=True)))
+
+def make_etag(version, path, query_string):
+    digest = hashlib.sha256(f"{path}?{normalized_query(query_string)}".encode("utf-8")).hexdigest()[:16]
+    return f'"v{version}-{digest}"'
+
+def http_date(dt):
+    """ Naive UTC datetime as HTTP date, e.g. Sun, 06 Nov 1994 08:49:37 GMT """
+    return format_datetime(dt.replace(tzinfo=timezone.utc), usegmt=True)
+
+def etag_matches(if_none_match, etag):
+    """ Weak comparison as used for If-None-Match: W/ prefixes are ignored and * matches anything """
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate == etag:
+            return True
+    return False
+
+def not_modified_since(if_modified_since, updated_at):
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since is None or since.tzinfo is None:
+        return False
+    # HTTP dates have a resolution of one second
+    return updated_at.replace(microsecond=0, tzinfo=timezone.utc) <= since
+
+async def current_version():
+    """ Dataset version and when it was loaded, reading them from the database only when due """
+    if data_version.due():
+        async with await async_read_session() as db:
+            await data_version.current(db)
+    return data_version.version, data_version.updated_at
+
+class HTTPCacheMiddleware(object):
+    """ ASGI middleware adding validators and Cache-Control to GET responses of CACHEABLE_PATHS and
+    answering matching conditional requests with 304
+    """
+    def __init__(self, app, max_age=HTTP_CACHE_MAX_AGE):
+        self.app = app
+        self.cache_control = f"public, max-age={max_age}".encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if (not HTTP_CACHE_ENABLED or scope["type"] != "http" or scope["method"] != "GET"
+                or scope["path"].rstrip("/") not in CACHEABLE_PATHS):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            version, updated_at = await current_version()
+        except SQLAlchemyError:
+            logger.exception("Could not read the dataset version, responding without cache headers")
+            version = None
+        if version is None:
+            await self.app(scope, receive, send)
+            return
+
+        etag = make_etag(version, scope["path"].rstrip("/"), scope["query_string"])
+        validators = [(b"etag", etag.encode("latin-1")), (b"cache-control", self.cache_control)]
+        if updated_at is not None:
+            validators.append((b"last-modified", http_date(updated_at).encode("latin-1")))
+
+        request_headers = dict((name.decode("latin-1").lower(), value.decode("latin-1")) for name, value in scope["headers"])
+        if "if-none-match" in request_headers:
+            not_modified = etag_matches(request_headers["if-none-match"], etag)
+        elif "if-modified-since" in request_headers and updated_at is not None:
+            not_modified = not_modified_since(request_headers["if-modified-since"], updated_at)
+        else:
+            not_modified = False
+
+        if not_modified:
+            await send({"type": "http.response.start", "status": 304, "headers": validators})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_validators(message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                headers = [(name, value) for name, value in message.get("headers", [])
+                           if name.lower() not in (b"etag", b"cache-control", b"last-modified")]
+                message = {**message, "headers": headers + validators}
+            await send(message)
+
+        await self.app(scope, receive, send_with_validators)
@@ -0,0 +1,154 @@
+""" Per-request instrumentation
+
+RequestStats collects, for the request being handled, the number of SQL statements, the time spent
+in the database, the rows fetched and the time spent serializing the endpoint's result. Rows are
+known only when the driver reports a rowcount (not for SELECTs on SQLite), otherwise they are None
+and reported as unknown. The
+SQLAlchemy event hooks in repeats/database.py add to the stats of the current request through a
+context variable, which FastAPI carries over to the threads sync endpoints run in.
+
+InstrumentationMiddleware reports the stats as a Server-Timing response header and as one
+structured log line per request, and records latency, response size and in-flight requests in the
+Prometheus metrics of metrics.py.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import time
+
+from fastapi.routing import APIRoute
+from starlette.routing import Match
+
+from . import metrics
+
+logger = logging.getLogger("strAPI.requests")
+
+class RequestStats(object):
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        # None until a statement reports its rowcount
+        self.rows = None
+        self.endpoint_done = None
+        self.response_started = None
+
+    def add_statement(self, duration, rows):
+        self.statements += 1
+        self.db_time += duration
+        if rows >= 0:
+            self.rows = (self.rows or 0) + rows
+
+    @property
+    def serialization_time(self):
+        if self.endpoint_done is None or self.response_started is None:
+            return 0.0
+        return max(self.response_started - self.endpoint_done, 0.0)
+
+    def server_timing(self):
+        """ Value of the Server-Timing header, durations in milliseconds """
+        total = (self.response_started or time.perf_counter()) - self.started
+        return ", ".join([
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.statements} statements, {"unknown" if self.rows is None else self.rows} rows"',
+            f"serialize;dur={self.serialization_time * 1000:.1f}",
+            f"total;dur={total * 1000:.1f}",
+        ])
+
+_current_stats = contextvars.ContextVar("request_stats", default=None)
+
+def current_stats():
+    """ Stats of the request being handled, None outside of a request """
+    return _current_stats.get()
+
+def mark_endpoint_done():
+    stats = current_stats()
+    if stats is not None:
+        stats.endpoint_done = time.perf_counter()
+
+def timed_endpoint(endpoint):
+    """ Wrap endpoint so that the moment it returns is recorded, everything up to the response
+    being sent after that is counted as serialization
+    """
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                mark_endpoint_done()
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                mark_endpoint_done()
+    return wrapper
+
+class TimedRoute(APIRoute):
+    """ Route class recording when the endpoint returns, set as app.router.route_class """
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+def route_template(scope):
+    """ Path template of the route handling scope (e.g. /repeats/{repeat_id}), used as metrics
+    label so that the number of label values stays bounded
+    """
+    app = scope.get("app")
+    for route in getattr(app, "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+class InstrumentationMiddleware(object):
+    """ ASGI middleware adding a Server-Timing header to every response and logging one line of
+    JSON per request once its body has been sent
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current_stats.set(stats)
+        status = None
+        body_size = 0
+        metrics.requests_in_flight.inc()
+
+        async def send_with_timing(message):
+            nonlocal status, body_size
+            if message["type"] == "http.response.body":
+                body_size += len(message.get("body", b""))
+            elif message["type"] == "http.response.start":
+                stats.response_started = time.perf_counter()
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", stats.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_stats.reset(token)
+            total = time.perf_counter() - stats.started
+            route = route_template(scope)
+            metrics.requests_in_flight.dec()
+            metrics.request_latency.observe(total, scope["method"], route, status or 500)
+            metrics.response_size.observe(body_size, scope["method"], route)
+            logger.info(json.dumps({
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status,
+                "statements": stats.statements,
+                "db_ms": round(stats.db_time * 1000, 1),
+                "rows": stats.rows,
+                "serialize_ms": round(stats.serialization_time * 1000, 1),
+                "total_ms": round(total * 1000, 1),
+            }))
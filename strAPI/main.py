@@ -1,6 +1,4 @@
 import os
-import io
-import csv
 import logging
 import sys
 from sqlalchemy.orm import joinedload
@@ -12,22 +10,31 @@ if __name__ == '__main__':
    del dirname
 
 from . import genes as gn
+from . import repeat_queries as rq
+from . import export
+from . import instrumentation
+from . import metrics
+from . import cache
+from . import http_cache
+from . import compression
+from . import pagination
 
 from typing import List, Optional
 
 from fastapi.openapi.utils import get_openapi
 from fastapi.staticfiles import StaticFiles
-from fastapi import Depends, FastAPI, Query
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import RedirectResponse
-from fastapi.responses import StreamingResponse
+from starlette.responses import RedirectResponse, Response
 
 import sqlalchemy
 from sqlmodel import Session, select 
-from sqlalchemy import nullslast
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from .repeats import models, schemas
-from .repeats.database import get_db
+from .repeats import database
+from .repeats.database import get_read_db, get_async_read_db
+from .utils.repeat_index import start_repeat_index
 
 # this is not needed if using alembic
 #models.Base.metadata.create_all(bind=engine)
@@ -65,6 +72,9 @@ app = FastAPI(
     docs_url=None
 )
 
+# Record when endpoints return so serialization time can be reported, see instrumentation.py
+app.router.route_class = instrumentation.TimedRoute
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 lable_lang_mapping = {"Python": "Python"}
@@ -118,22 +128,52 @@ def custom_openapi():
 
 
 app.openapi = custom_openapi
+# Inside CORSMiddleware so that 304 responses carry the CORS headers too
+app.add_middleware(http_cache.HTTPCacheMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
     allow_credentials=True,
+    expose_headers=pagination.EXPOSE_HEADERS,
 )
+app.add_middleware(compression.CompressionMiddleware)
+app.add_middleware(instrumentation.InstrumentationMiddleware)
+
+@app.on_event("startup")
+def build_repeat_index():
+    """ Build the in-memory repeat index in the background, see utils/repeat_index.py """
+    if rq.REPEAT_INDEX_ENABLED:
+        start_repeat_index()
+
+@app.on_event("shutdown")
+async def dispose_engines():
+    """ Close the pooled connections of the primary and the replicas. aiosqlite runs every connection
+    in a non-daemon thread, which would keep the process from exiting
+    """
+    await database.async_engine.dispose()
+    database.engine.dispose()
+    for replica in database.replica_router.replicas:
+        await replica.async_engine.dispose()
+        replica.engine.dispose()
 
 
 @app.get("/")
 def main():
     return RedirectResponse(url="/docs/")
 
+"""
+Prometheus metrics of this process: request latency and response size per route, requests in flight,
+database pool checkout wait and saturation, and cache hit rates, see metrics.py
+"""
+@app.get("/metrics", include_in_schema=False)
+def show_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 # Get 100 genes (testing query)
 @app.get("/genes/", response_model=List[schemas.Gene], tags=["Genes"])
-def show_genes(db: Session = Depends(get_db)):
+def show_genes(db: Session = Depends(get_read_db)):
     gene_names = ["MSH6", "CDK12", "CTCF", "PAK1", "KRAS", "PMS2", "MLH1", "MSH2" , "BAX", "MSH3", "TGFBR1"]
     genes = db.query(models.Gene).filter(models.Gene.name.in_(gene_names)).all()
     return genes
@@ -149,14 +189,18 @@ def show_genes(db: Session = Depends(get_db)):
     - Add features flag and return corresponding transcripts and exons
 """ 
 @app.get("/gene/", response_model=List[schemas.Gene], tags=["Genes"])
-def show_genes(db: Session = Depends(get_db), gene_names: List[str] = Query(None), ensembl_ids: List[str] = Query(None), reqion_query: str = Query(None)):
-    return gn.get_gene_info(db, gene_names, ensembl_ids, reqion_query)
+async def show_genes(db: AsyncSession = Depends(get_async_read_db), gene_names: List[str] = Query(None), ensembl_ids: List[str] = Query(None), reqion_query: str = Query(None)):
+    async def load_genes():
+        return [gene.dict() for gene in await gn.get_gene_info(db, gene_names, ensembl_ids, reqion_query)]
+
+    key = cache.cache_key("gene", gene_names=gene_names, ensembl_ids=ensembl_ids, reqion_query=reqion_query)
+    return await cache.cached(cache.genes, key, db, load_genes)
     
 
 @app.get("/genefeatures/", response_model=List[schemas.GeneInfo], tags=["Genes"])
-def show_gene_info(db: Session = Depends(get_db), gene_names: List[str] = Query(None), ensembl_ids: List[str] = Query(None), reqion_query: str = Query(None)):
-        genes = gn.get_gene_info(db, gene_names, ensembl_ids, reqion_query)
-        return gn.get_genes_with_exons(db, genes)
+async def show_gene_info(db: AsyncSession = Depends(get_async_read_db), gene_names: List[str] = Query(None), ensembl_ids: List[str] = Query(None), reqion_query: str = Query(None)):
+        genes = await gn.get_gene_info(db, gene_names, ensembl_ids, reqion_query)
+        return await gn.get_genes_with_exons(db, genes)
 
 
 """ 
@@ -170,12 +214,42 @@ Retrieve allele frequencies for the given repeat id
     List of Allele Frequencies
 """
 @app.get("/allfreqs/", response_model=List[schemas.AlleleFrequency], tags=["Repeats"])
-def show_allele_freqs(repeat_id: int, db: Session = Depends(get_db)):
-    allfreqs = db.query(models.AlleleFrequency).filter(models.AlleleFrequency.repeat_id == repeat_id).all()
+async def show_allele_freqs(repeat_id: int, format: Optional[str] = Query(None, regex=export.FORMAT_REGEX), compress: Optional[bool] = False,
+                      db: AsyncSession = Depends(get_async_read_db)):
+    statement = select(models.AlleleFrequency).where(models.AlleleFrequency.repeat_id == repeat_id)
+    if format:
+        allfreqs = (await db.stream(export.streaming_options(statement))).scalars()
+        rows = (rq.allele_frequency_row(allfreq) async for allfreq in allfreqs)
+        return export.export_response(rows, rq.ALLELE_FREQUENCY_COLUMNS, "allfreqs", format, compress)
+
+    allfreqs = (await db.exec(statement)).all()
     #if allfreqs == []:
     #    return []
     return allfreqs
 
+""" 
+Retrieve the allele frequencies of many repeats, given by id or by region, pivoted per population
+     
+   Parameters
+   batch (AlleleFrequencyBatch):
+        repeat_ids (at most WEBSTR_BATCH_MAX_IDS) or region_query, and optionally populations
+   format (str):
+        ndjson to stream one object per repeat per line instead of a JSON list
+   
+    Returns
+    Per repeat, ordered by id, and population the allele lengths and their frequencies as
+    parallel lists together with het and num_called
+"""
+@app.post("/allfreqs/batch", response_model=List[schemas.RepeatAlleleFrequencies], tags=["Repeats"])
+async def show_allele_freqs_batch(batch: schemas.AlleleFrequencyBatch, format: Optional[str] = Query(None, regex="^(json|ndjson)$"),
+                                  db: AsyncSession = Depends(get_async_read_db)):
+    if (batch.repeat_ids is None) == (batch.region_query is None):
+        raise HTTPException(status_code=400, detail="Give either repeat_ids or region_query")
+    rows = rq.iter_allele_frequency_batch(db, batch.repeat_ids, batch.region_query, batch.populations)
+    if format == "ndjson":
+        return export.ndjson_response(rows)
+    return [row async for row in rows]
+
 """ 
 Retrieve repeat info given a repeat id 
      
@@ -187,11 +261,39 @@ Retrieve repeat info given a repeat id
     Repeat info 
 """
 @app.get("/repeatinfo/", response_model=schemas.RepeatInfo, tags=["Repeats"])
-def show_repeat_info(repeat_id: int, db: Session = Depends(get_db)):
-    repeat = db.query(models.Repeat).filter(models.Repeat.id == repeat_id).one_or_none()
+async def show_repeat_info(repeat_id: int, db: AsyncSession = Depends(get_async_read_db)):
+    return await cache.cached(cache.repeat_info, cache.cache_key("repeatinfo", repeat_id=repeat_id), db,
+                              lambda: load_repeat_info(repeat_id, db))
+
+""" 
+Retrieve repeat info for many repeat ids at once
+     
+   Parameters
+   batch (RepeatInfoBatch):
+        repeat_ids, at most WEBSTR_BATCH_MAX_IDS of them
+   format (str):
+        ndjson to stream one RepeatInfo object per line instead of a JSON list
+   
+    Returns
+    Repeat info of every repeat found, in the order of repeat_ids. Looks the repeats up with one
+    query per 1000 ids instead of four per id as /repeatinfo
+"""
+@app.post("/repeatinfo/batch", response_model=List[schemas.RepeatInfo], tags=["Repeats"])
+async def show_repeat_info_batch(batch: schemas.RepeatInfoBatch, format: Optional[str] = Query(None, regex="^(json|ndjson)$"),
+                                 db: AsyncSession = Depends(get_async_read_db)):
+    rows = rq.iter_repeat_info_batch(db, batch.repeat_ids)
+    if format == "ndjson":
+        return export.ndjson_response(rows)
+    return [row async for row in rows]
+
+async def load_panel_name(trpanel_id, db):
+    return (await db.get(models.TRPanel, trpanel_id)).name
+
+async def load_repeat_info(repeat_id, db):
+    repeat = (await db.exec(select(models.Repeat).where(models.Repeat.id == repeat_id))).one_or_none()
 
     # Get CRC Variation associated with this repeat if available
-    crcvar = db.query(models.CRCVariation).filter(models.CRCVariation.repeat_id == repeat_id).first()
+    crcvar = (await db.exec(select(models.CRCVariation).where(models.CRCVariation.repeat_id == repeat_id))).first()
 
     if crcvar is None:
         crcvar_info = dict(total_calls=None, frac_variable = None, avg_size_diff = None)
@@ -202,14 +304,15 @@ def show_repeat_info(repeat_id: int, db: Session = Depends(get_db)):
     statement = select(models.GenesRepeatsLink, models.Gene     
     ).where(models.GenesRepeatsLink.repeat_id == repeat_id 
     ).join(models.Gene).where(models.Gene.id == models.GenesRepeatsLink.gene_id) 
-    gene = db.exec(statement).first()
+    gene = (await db.exec(statement)).first()
     
     if gene is not None:
         gene_info = dict(gene[1])
     else:
         gene_info = {'ensembl_id': None, 'strand': None, 'name': None, 'description': None}
     
-    tr_panel_name = db.query(models.TRPanel).get(repeat.trpanel_id).name
+    tr_panel_name = await cache.cached(cache.panel_names, cache.cache_key("trpanel", id=repeat.trpanel_id), db,
+                                       lambda: load_panel_name(repeat.trpanel_id, db))
     if tr_panel_name == 'hipstr_hg38':
        tr_panel_name = 'ensemble_tr'
 
@@ -241,121 +344,45 @@ Retrieve all repeats associated with a given gene
    Parameters
    gene (Gene):
         Ensembl id of a gene for which the repeats will be retrieved
+   page_token (str):
+        X-Next-Page-Token of the previous page, downloads are not paginated
    
     Returns
-    List of Repeats
+    List of Repeats, at most page_size of them
 """
 #TODO: Test on an example when there are multiple genes associated with the repeat
 @app.get("/repeats", response_model=List[schemas.RepeatInfo], tags=["Repeats"])
-def show_repeats(gene_names: List[str] = Query(None), ensembl_ids: List[str] = Query(None), region_query: str = Query(None), download: Optional[bool] = False, db: Session = Depends(get_db)):  
-    def repeats_to_list(repeats, region_query):
-        rows = []
-        
-        for r in iter(repeats):
-      
-            repeat = r[0]
-            gene_info = r[1]
-
-            if gene_info:
-                if region_query:
-                    gene = dict(db.query(models.Gene).get(gene_info.gene_id))
-                else:
-                    gene = dict(gene_info)
-            else:
-                gene = dict(ensembl_id = None,
-                            strand=None,
-                            name=None,
-                            description=None)
-            print(len(r))
-            if len(r) < 4:
-                crcvar_info = r[2]
-            elif len(r) == 4:
-                crcvar_info = r[3]
-            
-            if crcvar_info:
-                crcvar = dict(crcvar_info)
-            else:
-                crcvar = dict(total_calls=None, frac_variable = None, avg_size_diff = None)  
-
-            tr_panel_name = db.query(models.TRPanel).get(repeat.trpanel_id).name
-            if tr_panel_name == 'hipstr_hg38':
-                tr_panel_name = 'ensemble_tr'
-        
-            print(tr_panel_name)
-            rows.append({
-                "repeat_id": repeat.id,
-                "chr": repeat.chr,
-                "start":  repeat.start,
-                "end":  repeat.end,
-                "msa": repeat.msa,
-                "motif": repeat.motif,
-                "period": repeat.l_effective,
-                "copies": repeat.n_effective,
-                "ensembl_id": gene["ensembl_id"],
-                "strand": gene["strand"],
-                "gene_name": gene["name"],
-                "gene_desc": gene["description"],
-                "total_calls": crcvar["total_calls"],
-                "frac_variable": crcvar["frac_variable"],
-                "avg_size_diff": crcvar["avg_size_diff"],
-                "panel": tr_panel_name
-            })
-        return rows
-
-    def repeats_to_csv(repeats, region_query):
-        csvfile = io.StringIO()
-        headers = ['repeat_id','chr','start','end','msa','motif','motif', 'period','copies', 
-            'ensembl_id', 'strand','gene_name','gene_desc', 'total_calls',
-             'frac_variable', 'avg_size_diff', "panel"]
-        
-        writer = csv.DictWriter(csvfile, headers)
-        writer.writeheader()
-        for row in repeats_to_list(repeats, region_query):
-            writer.writerow(row)
-        csvfile.seek(0)
-        return(yield from csvfile)
-
-    # Retrieving things based on genes when gene_names
-    # TODO: 
-    # filter on period less than 7 
-    # join with panel name 
-    if not region_query:
-        genes = gn.get_gene_info(db, gene_names, ensembl_ids, region_query)
-        gene_obj_ids = [gene.id for gene in genes]
-        
-        statement = select(models.Repeat, models.Gene, models.GenesRepeatsLink, models.CRCVariation     #SELECT genes, repeats, genes_repeats FROM ((genes_repeats
-            ).join(models.Gene).where(models.Gene.id == models.GenesRepeatsLink.gene_id  #INNER JOIN genes ON genes.id = genes_repeats.gene_id)
-            ).join(models.Repeat).where(models.Repeat.id == models.GenesRepeatsLink.repeat_id #INNER JOIN repeats on repeats.id = genes_repeats.repeat_id)
-            ).filter(models.Gene.id.in_(gene_obj_ids)
-            ).filter(models.Repeat.l_effective <= 6 
-            ).join(models.CRCVariation, isouter=True 
-            ).order_by(nullslast(models.CRCVariation.frac_variable.desc())).order_by(models.CRCVariation.total_calls)
-    
-        repeats = db.exec(statement)
+async def show_repeats(request: Request, response: Response, gene_names: List[str] = Query(None), ensembl_ids: List[str] = Query(None), region_query: str = Query(None), download: Optional[bool] = False, 
+                 format: Optional[str] = Query(None, regex=export.FORMAT_REGEX), compress: Optional[bool] = False,
+                 page_token: Optional[str] = None, page_size: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+                 db: AsyncSession = Depends(get_async_read_db)):  
+    # Repeats, genes, CRC variation stats and panel names all come from a single statement (one per
+    # REPEAT_ID_CHUNK_SIZE repeats found in the repeat index), so the number of queries does not
+    # grow with the number of repeats
+    repeat_ids = None
+    if region_query and rq.REPEAT_INDEX_ENABLED:
+        repeat_ids = rq.region_repeat_ids(region_query)
+
+    if download or format:
+        # A download is streamed in the order of a single statement, so regions with more repeats
+        # than fit in one are scanned in the database instead
+        if repeat_ids is not None and len(repeat_ids) > rq.REPEAT_ID_CHUNK_SIZE:
+            repeat_ids = None
+        statement = rq.repeats_statement(gene_names, ensembl_ids, region_query, repeat_ids)
+        repeats = await db.stream(export.streaming_options(statement))
+        rows = (rq.repeat_info_row(*row) async for row in repeats)
+        return export.export_response(rows, rq.REPEAT_COLUMNS, "repeats", format or "csv", compress,
+                                      headers=rq.REPEAT_CSV_HEADERS)
     else:
-        region_split = region_query.split(':')
-        chrom = 'chr' + region_split[0]
-        coord_split = region_split[1].split('-')
-        start = int(coord_split[0])
-        end = int(coord_split[1])
-        #buf = int((end-start)*(GENEBUFFER))
-        #start = start-buf
-        #end = end+buf
-       
-        statement = select(models.Repeat, models.GenesRepeatsLink, models.CRCVariation    
-            ).select_from(models.Repeat
-            ).filter(models.Repeat.chr == chrom, models.Repeat.start >= start, models.Repeat.end <= end, models.Repeat.l_effective <= 6
-            ).join(models.GenesRepeatsLink, isouter=True
-            ).join(models.CRCVariation, isouter=True
-            ).order_by(nullslast(models.CRCVariation.frac_variable.desc())).order_by(models.CRCVariation.total_calls)
-    
-        
-        repeats = db.exec(statement)
-    if download:
-        return StreamingResponse(repeats_to_csv(repeats, region_query), media_type="text/csv")
-    else:
-        results = repeats_to_list(repeats, region_query)
-        return results
+        # Large regions from the repeat index take one statement per chunk of ids, whose pages are merged
+        pages = []
+        for statement in rq.repeats_statements(gene_names, ensembl_ids, region_query, repeat_ids):
+            statement = pagination.paginate(statement, rq.REPEAT_SORT_KEYS, page_token, page_size)
+            pages.append(await db.exec(statement))
+        rows = pagination.merge_pages(pages, rq.REPEAT_SORT_KEYS, rq.repeat_sort_key) if len(pages) > 1 else pages[0]
+        rows, next_token = pagination.page_rows(rows, page_size, rq.repeat_sort_key)
+        pagination.set_next_page(response, request, next_token)
+        return rq.repeats_to_list(rows)
 
 """ 
 Retrieve all variations given a repeat id 
@@ -381,49 +408,29 @@ Retrieve all STR variations found in the genes associated with given gene names
         Gene name
    
     Returns
-    Streams a csv file of variations for the given gene
+    Streams a csv file of variations for the given gene, or lists at most page_size of them
+    starting after page_token
 """
 @app.get("/variations/", response_model=List[schemas.CRCVariation], tags=["Variations"])
-def show_str_variation_in_genes(gene_names: List[str] = Query(None), download: Optional[bool] = False, db: Session = Depends(get_db)):
-    def variations_to_csv(variations):
-        csvfile = io.StringIO()
-        headers = ['patient','sample_type','repeat_id','start','end','ref','alt']
-        rows = []
-        for var in variations:
-            rows.append(
-                {
-                    'patient': var.tcga_barcode,
-                    'sample_type': var.sample_type,
-                    'repeat_id': var.repeat_id,
-                    'start': var.start,
-                    'end': var.end,
-                    'ref': var.reference,
-                    'alt': var.alt
-                }
-            )
-        writer = csv.DictWriter(csvfile, headers)
-        writer.writeheader()
-        for row in rows:
-            writer.writerow(row)
-        csvfile.seek(0)
-        return(yield from csvfile)
-    
-    genes =  db.query(models.Gene).with_entities(models.Gene.id).filter(models.Gene.name.in_(gene_names)).all()
-    gene_ids = [id[0] for id in genes]
-    repeats = db.query(models.Repeat).with_entities(models.Repeat.id).filter(models.Repeat.genes.any(
-            models.GenesRepeatsLink.gene_id.in_(gene_ids))).all()
-    repeat_ids = [id[0] for id in repeats]
-
-    variations = db.query(models.CRCVariation).filter(models.CRCVariation.repeat_id.in_(repeat_ids)).all()
-
-    if download:
-        return StreamingResponse(variations_to_csv(variations), media_type="text/csv")
+def show_str_variation_in_genes(request: Request, response: Response, gene_names: List[str] = Query(None), download: Optional[bool] = False,
+                                format: Optional[str] = Query(None, regex=export.FORMAT_REGEX), compress: Optional[bool] = False,
+                                page_token: Optional[str] = None, page_size: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+                                db: Session = Depends(get_read_db)):
+    statement = rq.variations_statement(gene_names)
+
+    if download or format:
+        variations = db.exec(export.streaming_options(statement))
+        rows = (rq.variation_row(var) for var in variations)
+        return export.export_response(rows, rq.VARIATION_COLUMNS, "variations", format or "csv", compress)
     else:
+        statement = pagination.paginate(statement, rq.VARIATION_SORT_KEYS, page_token, page_size)
+        variations, next_token = pagination.page_rows(db.exec(statement), page_size, rq.variation_sort_key)
+        pagination.set_next_page(response, request, next_token)
         return variations
 
 # for gene return all transcripts
 @app.get("/transcript/{gene}", response_model=List[schemas.Transcript], tags=["Genes"])
-def show_transcripts(gene: str, db: Session = Depends(get_db)):
+def show_transcripts(gene: str, db: Session = Depends(get_read_db)):
     transcripts = db.query(models.Transcript).filter_by(ensembl_transcript=gene).all()
     return transcripts
 
@@ -440,21 +447,34 @@ def show_transcripts(gene: str, db: Session = Depends(get_db)):
     reverse strand, order will be descending.
 """
 @app.get("/exons/", response_model=List[schemas.Exon], tags=["Genes"])
-def get_sorted_exons(transcript: str, protein: bool = False, db: Session = Depends(get_db)):
+def get_sorted_exons(transcript: str, protein: bool = False, db: Session = Depends(get_read_db)):
     return genes.get_exons_by_transcript(db, protein, transcript)
 
-""" Retrieve all CRC Gene Expression Repeat Length Correlations
+""" Retrieve all CRC Gene Expression Repeat Length Correlations, strongest first
+
+    Parameters
+    page_token (str):
+                X-Next-Page-Token of the previous page
+    page_size (int):
+                Number of correlations per page
+    limit (int):
+                Deprecated alias of page_size
 
     Returns
     List of correlations between genes and a specific repeat length in CRC patients
 """
 @app.get("/crc_expr_repeatlen_corr/", response_model=List[schemas.CRCExprRepeatLenCorr])
-def get_crc_expr_repeatlen_corr(db: Session = Depends(get_db), limit = 7000):
+def get_crc_expr_repeatlen_corr(request: Request, response: Response, db: Session = Depends(get_read_db), page_token: Optional[str] = None,
+                                page_size: int = Query(7000, ge=1, le=pagination.MAX_PAGE_SIZE),
+                                limit: Optional[int] = Query(None, ge=1, le=pagination.MAX_PAGE_SIZE, deprecated=True)):
+    if limit is not None:
+        page_size = limit
 
-    correlations = db.query(models.CRCExprRepeatLenCorr).order_by(
-        sqlalchemy.func.abs(models.CRCExprRepeatLenCorr.coefficient).desc()
-    ).limit(limit).options(
+    query = db.query(models.CRCExprRepeatLenCorr).options(
         joinedload(models.CRCExprRepeatLenCorr.gene), joinedload(models.CRCExprRepeatLenCorr.repeat)
-    ).all()
+    )
+    query = pagination.paginate(query, rq.CORRELATION_SORT_KEYS, page_token, page_size)
+    correlations, next_token = pagination.page_rows(query.all(), page_size, rq.correlation_sort_key)
+    pagination.set_next_page(response, request, next_token)
 
     return [{**c.gene.__dict__, **c.repeat.__dict__, **c.__dict__} for c in correlations]
\ No newline at end of file
@@ -0,0 +1,142 @@
+""" Minimal Prometheus metrics, exposed by the /metrics endpoint in the plain text exposition format
+
+Metrics are kept per process. When running several uvicorn replicas every replica is scraped
+on its own and Prometheus aggregates them.
+"""
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+_registry = []
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = dict()
+        _registry.append(self)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+class Gauge(Metric):
+    """ Gauge that is either set directly or computed by callback when scraped """
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=(), callback=None):
+        super().__init__(name, description, labels)
+        self.callback = callback
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def samples(self):
+        if self.callback is not None:
+            return [(self.name, format_labels(self.labels, key), value) for key, value in self.callback()]
+        with self.lock:
+            return [(self.name, format_labels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            # cumulative bucket counts, then sum and count of all observations
+            state = self.values.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", format_labels(self.labels, key, [("le", bound)]), bucket_count))
+                samples.append((f"{self.name}_bucket", format_labels(self.labels, key, [("le", "+Inf")]), count))
+                samples.append((f"{self.name}_sum", format_labels(self.labels, key), total))
+                samples.append((f"{self.name}_count", format_labels(self.labels, key), count))
+        return samples
+
+def render():
+    """ All metrics in the Prometheus text exposition format """
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+request_latency = Histogram("webstr_http_request_duration_seconds", "Time from receiving a request until its response body was sent",
+                            labels=("method", "route", "status"))
+response_size = Histogram("webstr_http_response_size_bytes", "Size of response bodies",
+                          labels=("method", "route"), buckets=SIZE_BUCKETS)
+requests_in_flight = Gauge("webstr_http_requests_in_flight", "Requests currently being handled")
+pool_checkout_wait = Histogram("webstr_db_pool_checkout_wait_seconds", "Time spent waiting for a database connection from the pool",
+                               buckets=WAIT_BUCKETS)
+read_sessions = Counter("webstr_db_read_sessions_total", "Sessions of read-only endpoints by the database they were opened on",
+                        labels=("database",))
+cache_requests = Counter("webstr_cache_requests_total", "Cache lookups by cache and result (hit or miss)",
+                         labels=("cache", "result"))
+
+def record_read_session(database):
+    read_sessions.inc(database)
+
+def record_cache(cache, hit):
+    cache_requests.inc(cache, "hit" if hit else "miss")
+
+_pools = dict()
+
+def pool_usage():
+    for name, pool in sorted(_pools.items()):
+        # Pools without a fixed size (NullPool, StaticPool) have nothing to report
+        if not hasattr(pool, "checkedout"):
+            continue
+        checked_out = pool.checkedout()
+        capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+        yield (name, "checked_out"), checked_out
+        yield (name, "capacity"), capacity
+        yield (name, "saturation"), checked_out / capacity if capacity else 0
+
+pool_connections = Gauge("webstr_db_pool", "Database connections checked out, pool capacity and their ratio",
+                         labels=("pool", "measure"), callback=pool_usage)
+
+def register_pool(engine, name="primary"):
+    """ Export the connection pool usage of engine, sampled when /metrics is scraped """
+    _pools[name] = engine.pool
@@ -0,0 +1,106 @@
+""" Keyset (cursor) pagination
+
+Pages are ordered by a sort key that is unique per row, and the next page starts after the last
+key of the previous one instead of skipping the earlier rows with OFFSET. Where the sort keys are
+indexed columns of one table a page is an index range scan however deep the client pages. Keys
+computed over joins (e.g. the coalesced CRC variation stats of /repeats) can't use an index, the
+database still filters and sorts the rows of the query on every page but only returns one page.
+
+The last key is handed to the client as an opaque token in the X-Next-Page-Token header and in a
+Link header with rel="next"; it is absent on the last page. Clients pass it back as the page_token
+parameter. Both headers are exposed to cross-origin clients (see EXPOSE_HEADERS).
+"""
+import base64
+import binascii
+import json
+import os
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = int(os.environ.get("WEBSTR_DEFAULT_PAGE_SIZE", "10000"))
+MAX_PAGE_SIZE = int(os.environ.get("WEBSTR_MAX_PAGE_SIZE", "50000"))
+
+# Response headers carrying the next page, browsers only let cross-origin scripts read them when
+# they are listed in Access-Control-Expose-Headers
+EXPOSE_HEADERS = ["X-Next-Page-Token", "Link"]
+
+def encode_token(key):
+    """ Opaque page token for the sort key values of the last row of a page """
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_token(token, length):
+    """ Sort key values encoded in token, raising a 400 error if it was not made by encode_token
+    for a key of length values
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid page_token")
+    if not isinstance(key, list) or len(key) != length:
+        raise HTTPException(status_code=400, detail="Invalid page_token")
+    # Sort keys are numbers and strings, anything else can't be compared with a column
+    if not all(isinstance(value, (int, float, str)) and not isinstance(value, bool) for value in key):
+        raise HTTPException(status_code=400, detail="Invalid page_token")
+    return key
+
+def after(keys, values):
+    """ Condition selecting the rows that come after values in the order of keys
+
+    Parameters
+    keys:   List of (column expression, descending) pairs, together unique per row
+    values: Sort key values of the last row of the previous page
+    """
+    (column, descending), value = keys[0], values[0]
+    beyond = column < value if descending else column > value
+    if len(keys) == 1:
+        return beyond
+    return or_(beyond, and_(column == value, after(keys[1:], values[1:])))
+
+def order_by(keys):
+    return [column.desc() if descending else column.asc() for column, descending in keys]
+
+def paginate(statement, keys, page_token=None, page_size=DEFAULT_PAGE_SIZE):
+    """ statement ordered by keys, limited to one page starting after page_token
+
+    One row more than page_size is selected, to tell whether there is a next page, see page_rows
+    """
+    if page_token:
+        statement = statement.filter(after(keys, decode_token(page_token, len(keys))))
+    return statement.order_by(None).order_by(*order_by(keys)).limit(page_size + 1)
+
+def merge_pages(pages, keys, sort_key):
+    """ Rows of several paginate statements over disjoint sets of rows, in the order of keys.
+    page_rows of the result is the page of their union
+
+    Parameters
+    pages:      Rows selected by each statement
+    keys:       Keys given to paginate
+    sort_key:   Function returning the sort key values of a row as a list
+    """
+    rows = [row for page in pages for row in page]
+    # Stable sorts from the last key to the first, as the keys can be descending and of any type
+    for i in reversed(range(len(keys))):
+        rows.sort(key=lambda row: sort_key(row)[i], reverse=keys[i][1])
+    return rows
+
+def page_rows(rows, page_size, sort_key):
+    """ Rows of the page and the token of the next page, None on the last page
+
+    Parameters
+    rows:       Rows selected by a statement from paginate
+    page_size:  Page size given to paginate
+    sort_key:   Function returning the sort key values of a row as a list
+    """
+    rows = list(rows)
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, encode_token(sort_key(rows[-1]))
+
+def set_next_page(response, request, next_token):
+    """ Add the X-Next-Page-Token and Link headers for next_token to response """
+    if next_token is None:
+        return
+    response.headers["X-Next-Page-Token"] = next_token
+    response.headers["Link"] = f'<{request.url.include_query_params(page_token=next_token)}>; rel="next"'
@@ -0,0 +1,281 @@
+import itertools
+import os
+
+from sqlmodel import select
+from sqlalchemy import nullslast, false, func
+
+from . repeats import models
+from . genes import parse_region
+from . utils.binning import bin_filter
+from . utils.repeat_index import get_repeat_index
+
+# Panel names as they are presented to the users of the API
+PANEL_DISPLAY_NAMES = {"hipstr_hg38": "ensemble_tr"}
+
+# Maximum motif length for a repeat to be considered an STR
+MAX_PERIOD = 6
+
+# Columns of the /repeats csv download
+REPEAT_CSV_HEADERS = ['repeat_id','chr','start','end','msa','motif','motif', 'period','copies', 
+    'ensembl_id', 'strand','gene_name','gene_desc', 'total_calls',
+    'frac_variable', 'avg_size_diff', "panel"]
+
+# Columns and their Arrow types for arrow and parquet downloads
+REPEAT_COLUMNS = [("repeat_id", "int64"), ("chr", "string"), ("start", "int64"), ("end", "int64"),
+    ("msa", "string"), ("motif", "string"), ("period", "int32"), ("copies", "int32"),
+    ("ensembl_id", "string"), ("strand", "string"), ("gene_name", "string"), ("gene_desc", "string"),
+    ("total_calls", "int64"), ("frac_variable", "double"), ("avg_size_diff", "double"), ("panel", "string")]
+
+# Arrow types of the python types of table columns
+ARROW_TYPES = {int: "int64", float: "double", str: "string"}
+
+def table_columns(model):
+    """ (name, arrow type) pairs of the columns of a table model, in declaration order """
+    return [(column.name, ARROW_TYPES[column.type.python_type]) for column in model.__table__.columns]
+
+VARIATION_COLUMNS = table_columns(models.CRCVariation)
+
+# Columns of the /variations csv download
+VARIATION_CSV_HEADERS = [column for column, _ in VARIATION_COLUMNS]
+
+ALLELE_FREQUENCY_COLUMNS = [("population", "string"), ("n_effective", "int32"), ("frequency", "double"),
+    ("het", "double"), ("num_called", "int64"), ("repeat_id", "int64")]
+
+# Resolve region queries with the in-memory repeat index instead of a range scan in the database
+REPEAT_INDEX_ENABLED = os.environ.get("WEBSTR_REPEAT_INDEX_ENABLE", "") == "1"
+
+def panel_display_name(tr_panel_name):
+    return PANEL_DISPLAY_NAMES.get(tr_panel_name, tr_panel_name)
+
+# Number of repeat ids bound per statement when /repeats looks up the repeats found in the
+# repeat index, well below the 32767 bind parameters a statement can have
+REPEAT_ID_CHUNK_SIZE = 10000
+
+def region_repeat_ids(region_query):
+    """ Ids of the STRs lying within the queried region, looked up in the in-memory repeat index.
+    None while the index is not built yet, the region is then queried in the database
+    """
+    index = get_repeat_index()
+    if index is None:
+        return None
+    chrom, start, end = parse_region(region_query)
+    return index.contained(chrom, start, end, max_period=MAX_PERIOD)
+
+def repeats_statement(gene_names=None, ensembl_ids=None, region_query=None, repeat_ids=None):
+    """ Build a single statement that returns every repeat matching the query together with
+    its gene, its CRC variation stats and the name of its TR panel, so that the number of
+    queries per request doesn't depend on the number of repeats found
+
+    Parameters
+    gene_names (List[str]):  Gene names to retrieve the repeats for
+    ensembl_ids (List[str]): Ensembl ids to retrieve the repeats for, used if no gene names are given
+    region_query (str):      Region in the format '1:182393-1014541', takes precedence over genes
+    repeat_ids (List[int]):  Ids of the repeats in region_query when already resolved by region_repeat_ids
+
+    Returns
+    Select statement yielding (Repeat, Gene, CRCVariation, TRPanel.name) rows, where Gene and
+    CRCVariation are None when not available
+    """
+    statement = select(models.Repeat, models.Gene, models.CRCVariation, models.TRPanel.name
+        ).select_from(models.Repeat
+        ).join(models.TRPanel, models.TRPanel.id == models.Repeat.trpanel_id
+        ).filter(models.Repeat.l_effective <= MAX_PERIOD)
+
+    if region_query:
+        statement = statement.join(models.GenesRepeatsLink, models.GenesRepeatsLink.repeat_id == models.Repeat.id, isouter=True
+            ).join(models.Gene, models.Gene.id == models.GenesRepeatsLink.gene_id, isouter=True)
+        if repeat_ids is not None:
+            statement = statement.filter(models.Repeat.id.in_(repeat_ids))
+        else:
+            chrom, start, end = parse_region(region_query)
+            statement = statement.filter(models.Repeat.chr == chrom, bin_filter(models.Repeat.bin, start, end),
+                models.Repeat.start >= start, models.Repeat.end <= end)
+    else:
+        statement = statement.join(models.GenesRepeatsLink, models.GenesRepeatsLink.repeat_id == models.Repeat.id
+            ).join(models.Gene, models.Gene.id == models.GenesRepeatsLink.gene_id)
+        if gene_names:
+            statement = statement.filter(models.Gene.name.in_(gene_names))
+        elif ensembl_ids:
+            statement = statement.filter(models.Gene.ensembl_id.in_(ensembl_ids))
+        else:
+            statement = statement.filter(false())
+
+    return statement.join(models.CRCVariation, models.CRCVariation.repeat_id == models.Repeat.id, isouter=True
+        ).order_by(nullslast(models.CRCVariation.frac_variable.desc())).order_by(models.CRCVariation.total_calls)
+
+def repeats_statements(gene_names=None, ensembl_ids=None, region_query=None, repeat_ids=None):
+    """ repeats_statement for every REPEAT_ID_CHUNK_SIZE of repeat_ids, a single statement if
+    no ids are given. Each statement is ordered on its own
+    """
+    if repeat_ids is None:
+        return [repeats_statement(gene_names, ensembl_ids, region_query)]
+    return [repeats_statement(gene_names, ensembl_ids, region_query, repeat_ids[i:i + REPEAT_ID_CHUNK_SIZE])
+            for i in range(0, max(len(repeat_ids), 1), REPEAT_ID_CHUNK_SIZE)]
+
+# Sort key of /repeats pages, the order of repeats_statement with missing CRC variation stats as -1.
+# Repeats linked to several genes are listed once per gene, so the gene id completes the key
+REPEAT_SORT_KEYS = [
+    (func.coalesce(models.CRCVariation.frac_variable, -1.0), True),
+    (func.coalesce(models.CRCVariation.total_calls, -1), False),
+    (models.Repeat.id, False),
+    (func.coalesce(models.Gene.id, 0), False),
+]
+
+def repeat_sort_key(row):
+    repeat, gene, crcvar, _ = row
+    frac_variable = crcvar.frac_variable if crcvar and crcvar.frac_variable is not None else -1.0
+    total_calls = crcvar.total_calls if crcvar and crcvar.total_calls is not None else -1
+    return [frac_variable, total_calls, repeat.id, gene.id if gene else 0]
+
+def repeat_info_row(repeat, gene, crcvar, tr_panel_name):
+    """ Flatten a repeat and its associated gene, CRC variation and panel into the
+    schemas.RepeatInfo shape
+    """
+    return {
+        "repeat_id": repeat.id,
+        "chr": repeat.chr,
+        "start":  repeat.start,
+        "end":  repeat.end,
+        "msa": repeat.msa,
+        "motif": repeat.motif,
+        "period": repeat.l_effective,
+        "copies": repeat.n_effective,
+        "ensembl_id": gene.ensembl_id if gene else None,
+        "strand": gene.strand if gene else None,
+        "gene_name": gene.name if gene else None,
+        "gene_desc": gene.description if gene else None,
+        "total_calls": crcvar.total_calls if crcvar else None,
+        "frac_variable": crcvar.frac_variable if crcvar else None,
+        "avg_size_diff": crcvar.avg_size_diff if crcvar else None,
+        "panel": panel_display_name(tr_panel_name)
+    }
+
+# Number of repeat ids looked up per statement by /repeatinfo/batch
+REPEAT_INFO_BATCH_QUERY_SIZE = 1000
+
+def repeat_info_statement(repeat_ids):
+    """ Statement returning the repeats with the given ids together with their genes, CRC variation
+    stats and panel names, in the shape of repeats_statement but for any repeat, linked to a gene
+    or not
+    """
+    return select(models.Repeat, models.Gene, models.CRCVariation, models.TRPanel.name
+        ).select_from(models.Repeat
+        ).join(models.TRPanel, models.TRPanel.id == models.Repeat.trpanel_id
+        ).join(models.GenesRepeatsLink, models.GenesRepeatsLink.repeat_id == models.Repeat.id, isouter=True
+        ).join(models.Gene, models.Gene.id == models.GenesRepeatsLink.gene_id, isouter=True
+        ).join(models.CRCVariation, models.CRCVariation.repeat_id == models.Repeat.id, isouter=True
+        ).where(models.Repeat.id.in_(repeat_ids))
+
+async def iter_repeat_info_batch(db, repeat_ids):
+    """ schemas.RepeatInfo dicts of the repeats with the given ids, in the order of repeat_ids
+    and with unknown ids left out, like /repeatinfo listing the first gene and CRC variation of
+    repeats that have several. Ids are looked up REPEAT_INFO_BATCH_QUERY_SIZE at a time, one
+    statement each
+
+    Parameters
+    db (AsyncSession):          Session to query
+    repeat_ids (List[int]):     Ids of the repeats, duplicates are returned once
+    """
+    repeat_ids = list(dict.fromkeys(repeat_ids))
+    for i in range(0, len(repeat_ids), REPEAT_INFO_BATCH_QUERY_SIZE):
+        chunk = repeat_ids[i:i + REPEAT_INFO_BATCH_QUERY_SIZE]
+        found = dict()
+        for row in await db.exec(repeat_info_statement(chunk)):
+            found.setdefault(row[0].id, row)
+        for repeat_id in chunk:
+            if repeat_id in found:
+                yield repeat_info_row(*found[repeat_id])
+
+def iter_repeat_info(rows):
+    return (repeat_info_row(*row) for row in rows)
+
+def repeats_to_list(rows):
+    return list(iter_repeat_info(rows))
+
+def allele_frequency_row(allfreq):
+    return {column: getattr(allfreq, column) for column, _ in ALLELE_FREQUENCY_COLUMNS}
+
+def allele_frequencies_statement(repeat_ids=None, region_query=None, populations=None):
+    """ Select statement yielding the allele frequency columns of the given repeats, or of all
+    repeats within region_query, ordered by repeat, population and allele length as
+    pivot_allele_frequencies expects. Plain columns are selected, no ORM objects are built
+
+    Parameters
+    repeat_ids (List[int]):     Ids of the repeats
+    region_query (str):         Region in the format '1:182393-1014541', used if no ids are given
+    populations (List[str]):    Populations to return, all if not given
+    """
+    af = models.AlleleFrequency
+    statement = select(af.repeat_id, af.population, af.n_effective, af.frequency, af.het, af.num_called)
+    if repeat_ids is not None:
+        statement = statement.where(af.repeat_id.in_(repeat_ids))
+    else:
+        chrom, start, end = parse_region(region_query)
+        statement = statement.join(models.Repeat, models.Repeat.id == af.repeat_id
+            ).where(models.Repeat.chr == chrom, bin_filter(models.Repeat.bin, start, end),
+                models.Repeat.start >= start, models.Repeat.end <= end)
+    if populations:
+        statement = statement.where(af.population.in_(populations))
+    return statement.order_by(af.repeat_id, af.population, af.n_effective)
+
+def pivot_allele_frequencies(rows):
+    """ Turn (repeat_id, population, n_effective, frequency, het, num_called) rows, ordered by
+    repeat and population, into one schemas.RepeatAlleleFrequencies dict per repeat, holding
+    parallel lists of allele lengths and frequencies per population
+    """
+    for repeat_id, repeat_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        populations = []
+        for population, population_rows in itertools.groupby(repeat_rows, key=lambda row: row[1]):
+            population_rows = list(population_rows)
+            populations.append({
+                "population": population,
+                "n_effective": [row[2] for row in population_rows],
+                "frequency": [row[3] for row in population_rows],
+                # het and num_called are the same for every allele of a population
+                "het": population_rows[0][4],
+                "num_called": population_rows[0][5],
+            })
+        yield {"repeat_id": repeat_id, "populations": populations}
+
+async def iter_allele_frequency_batch(db, repeat_ids=None, region_query=None, populations=None):
+    """ Pivoted allele frequencies (see pivot_allele_frequencies) of the given repeats, looked up
+    REPEAT_INFO_BATCH_QUERY_SIZE ids per statement, or of the repeats within region_query
+    """
+    if repeat_ids is None:
+        rows = (await db.exec(allele_frequencies_statement(region_query=region_query, populations=populations))).all()
+        for repeat in pivot_allele_frequencies(rows):
+            yield repeat
+        return
+
+    repeat_ids = sorted(set(repeat_ids))
+    for i in range(0, len(repeat_ids), REPEAT_INFO_BATCH_QUERY_SIZE):
+        chunk = repeat_ids[i:i + REPEAT_INFO_BATCH_QUERY_SIZE]
+        rows = (await db.exec(allele_frequencies_statement(chunk, populations=populations))).all()
+        for repeat in pivot_allele_frequencies(rows):
+            yield repeat
+
+def variations_statement(gene_names):
+    """ Select statement yielding the CRC variations of all repeats associated with the given genes
+    """
+    repeat_ids = select(models.GenesRepeatsLink.repeat_id
+        ).join(models.Gene, models.Gene.id == models.GenesRepeatsLink.gene_id
+        ).where(models.Gene.name.in_(gene_names or []))
+    return select(models.CRCVariation).where(models.CRCVariation.repeat_id.in_(repeat_ids))
+
+VARIATION_SORT_KEYS = [(models.CRCVariation.id, False)]
+
+def variation_sort_key(var):
+    return [var.id]
+
+# Strongest correlations first, as before pagination
+CORRELATION_SORT_KEYS = [
+    (func.abs(models.CRCExprRepeatLenCorr.coefficient), True),
+    (models.CRCExprRepeatLenCorr.repeat_id, False),
+    (models.CRCExprRepeatLenCorr.gene_id, False),
+]
+
+def correlation_sort_key(correlation):
+    return [abs(correlation.coefficient), correlation.repeat_id, correlation.gene_id]
+
+def variation_row(var):
+    return {column: getattr(var, column) for column, _ in VARIATION_COLUMNS}
@@ -1,14 +1,26 @@
+import itertools
 import os
 import logging
 import sys
+import threading
+import time
 from io import StringIO
 
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
 from sqlmodel import create_engine, Session, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from alembic.config import Config as AlembicConfig
 from alembic.script import ScriptDirectory as AlembicScriptDirectory
 from alembic.migration import MigrationContext
 
+from ..instrumentation import current_stats
+from .. import metrics
+
 DATABASE_URL = os.environ['DATABASE_URL']
 
 # Convert "postgres://<db_address>"  --> "postgresql+psycopg2://<db_address>" needed for SQLAlchemy
@@ -49,7 +61,162 @@ def check_db_version(engine, config_file: str = os.path.join(os.path.split(__fil
   This can require changing database url in alembic.ini and running alembic upgrade head
   """) 
 
-engine = create_engine(final_db_url, echo=False)
+"""
+Engine and connection pool settings, all read from the environment
+
+WEBSTR_DB_POOL_SIZE               Connections kept open in the pool
+WEBSTR_DB_MAX_OVERFLOW            Extra connections opened under load, closed again when returned
+WEBSTR_DB_POOL_TIMEOUT            Seconds to wait for a free connection before failing the request
+WEBSTR_DB_POOL_RECYCLE            Seconds after which a connection is replaced, -1 to keep them forever
+WEBSTR_DB_POOL_PRE_PING           1 to test connections when they are checked out
+WEBSTR_DB_STATEMENT_TIMEOUT_MS    Postgres statement_timeout in milliseconds, 0 for none
+WEBSTR_DB_PREPARED_STATEMENTS     1 to let asyncpg prepare and cache statements on the server
+WEBSTR_DB_PGBOUNCER               1 when connecting through PgBouncer in transaction mode: PgBouncer does
+                                  the pooling, so connections are not pooled here, startup options
+                                  are not sent and prepared statements are disabled
+WEBSTR_SQLITE_MMAP_SIZE           SQLite mmap_size pragma in bytes
+WEBSTR_SQLITE_CACHE_SIZE          SQLite cache_size pragma, negative values are in KiB
+"""
+POOL_SIZE = int(os.environ.get("WEBSTR_DB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.environ.get("WEBSTR_DB_MAX_OVERFLOW", "20"))
+POOL_TIMEOUT = float(os.environ.get("WEBSTR_DB_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.environ.get("WEBSTR_DB_POOL_RECYCLE", "1800"))
+POOL_PRE_PING = os.environ.get("WEBSTR_DB_POOL_PRE_PING", "1") == "1"
+STATEMENT_TIMEOUT_MS = int(os.environ.get("WEBSTR_DB_STATEMENT_TIMEOUT_MS", "0"))
+PGBOUNCER = os.environ.get("WEBSTR_DB_PGBOUNCER", "") == "1"
+PREPARED_STATEMENTS = os.environ.get("WEBSTR_DB_PREPARED_STATEMENTS", "1") == "1" and not PGBOUNCER
+SQLITE_MMAP_SIZE = int(os.environ.get("WEBSTR_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.environ.get("WEBSTR_SQLITE_CACHE_SIZE", "-65536"))
+
+def is_sqlite_memory(url):
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+def connect_args(url):
+    """ Driver specific connection arguments for the statement timeout and prepared statements """
+    args = dict()
+    if url.get_backend_name() == "sqlite":
+        # Connections are used by one thread at a time only, but not always the one that opened them
+        args["check_same_thread"] = False
+    elif url.get_driver_name() == "asyncpg":
+        if STATEMENT_TIMEOUT_MS and not PGBOUNCER:
+            args["server_settings"] = {"statement_timeout": str(STATEMENT_TIMEOUT_MS)}
+        if not PREPARED_STATEMENTS:
+            args["statement_cache_size"] = 0
+            args["prepared_statement_cache_size"] = 0
+    elif STATEMENT_TIMEOUT_MS and not PGBOUNCER and url.get_backend_name() == "postgresql":
+        args["options"] = f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"
+    return args
+
+def engine_options(db_url, queue_pool=QueuePool):
+    """ Keyword arguments of create_engine (or create_async_engine, with queue_pool set to
+    AsyncAdaptedQueuePool) for db_url according to the settings above
+    """
+    url = make_url(db_url)
+    if is_sqlite_memory(url):
+        # Every connection would see its own empty database, keep the default single connection pool
+        return dict()
+
+    # SQLAlchemy doesn't pool SQLite file databases by default, pooling keeps the mmap and page
+    # cache of a connection between requests
+    options = dict(
+        poolclass = queue_pool,
+        pool_size = POOL_SIZE,
+        max_overflow = MAX_OVERFLOW,
+        pool_timeout = POOL_TIMEOUT,
+        pool_recycle = POOL_RECYCLE,
+        pool_pre_ping = POOL_PRE_PING,
+    )
+    if PGBOUNCER and url.get_backend_name() == "postgresql":
+        options = dict(poolclass=NullPool, pool_pre_ping=POOL_PRE_PING)
+    options["connect_args"] = connect_args(url)
+    return options
+
+def configure_connections(engine):
+    """ Per-connection settings that can't be passed to the driver when connecting """
+    if engine.dialect.name == "sqlite" and not is_sqlite_memory(engine.url):
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            # WAL lets readers and the loaders' writes proceed at the same time
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+            cursor.execute("PRAGMA busy_timeout=5000")
+            cursor.close()
+
+    elif PGBOUNCER and STATEMENT_TIMEOUT_MS and engine.dialect.name == "postgresql":
+        # PgBouncer rejects startup options and shares server connections between clients, so
+        # the timeout is set for each transaction only
+        @event.listens_for(engine, "begin")
+        def set_statement_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {STATEMENT_TIMEOUT_MS}")
+
+    return engine
+
+engine = configure_connections(create_engine(final_db_url, echo=False, **engine_options(final_db_url)))
+metrics.register_pool(engine)
+
+def async_db_url(db_url):
+    """ URL of the same database for the asyncio drivers, asyncpg for Postgres and aiosqlite for SQLite """
+    url = make_url(db_url)
+    if url.get_backend_name() == "postgresql":
+        return url.set(drivername="postgresql+asyncpg")
+    if url.get_backend_name() == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    return url
+
+"""
+Engine of the async endpoints. Statements run on the event loop instead of blocking a thread of
+the threadpool sync endpoints run in, so concurrency is bounded by the pool instead of the threads
+"""
+final_async_db_url = async_db_url(final_db_url)
+async_engine = create_async_engine(final_async_db_url, echo=False,
+                                   **engine_options(final_async_db_url, AsyncAdaptedQueuePool))
+configure_connections(async_engine.sync_engine)
+metrics.register_pool(async_engine.sync_engine, "primary_async")
+
+"""
+Count statements, database time and fetched rows of every request, see strAPI/instrumentation.py
+
+Statements slower than WEBSTR_SLOW_QUERY_MS milliseconds are logged together with their query plan.
+Rows are counted from the DBAPI rowcount, which is only known for some drivers and cursors (psycopg2
+client-side cursors). SQLite reports -1 for SELECTs, so there the rows of a request are unknown and
+logged as null. The start time is kept on the statement's execution context, so a statement that
+fails leaves nothing behind
+"""
+SLOW_QUERY_MS = float(os.environ.get("WEBSTR_SLOW_QUERY_MS", "0"))
+slow_query_logger = logging.getLogger("strAPI.slow_queries")
+
+def explain(conn, statement, parameters):
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    conn.info["explaining"] = True
+    try:
+        return "\n".join(" ".join(str(v) for v in row) for row in conn.exec_driver_sql(prefix + statement, parameters))
+    except Exception as e:
+        return f"EXPLAIN failed: {e}"
+    finally:
+        conn.info["explaining"] = False
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.webstr_query_start = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context.webstr_query_start
+    if conn.info.get("explaining"):
+        return
+
+    stats = current_stats()
+    if stats is not None:
+        stats.add_statement(duration, cursor.rowcount)
+
+    if SLOW_QUERY_MS and duration * 1000 > SLOW_QUERY_MS and not executemany:
+        slow_query_logger.warning("Slow query (%.1f ms):\n%s\nParameters: %s\nPlan:\n%s",
+            duration * 1000, statement, parameters, explain(conn, statement, parameters))
+
+for instrumented_engine in (engine, async_engine.sync_engine):
+    event.listen(instrumented_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(instrumented_engine, "after_cursor_execute", after_cursor_execute)
 
 """
 WARNING: Alembic functionality was teste but not used by default. Treat it as a POC for future versions.
@@ -57,6 +224,150 @@ WARNING: Alembic functionality was teste but not used by default. Treat it as a
 if os.environ.get("WEBSTR_DATABASE_MIGRATIONS_ENABLE", "")  == "1":
   check_db_version(engine)
 
+"""
+Read replicas
+
+DATABASE_REPLICA_URLS is a comma separated list of replicas of DATABASE_URL. Sessions of the read-only
+endpoints (get_read_db, get_async_read_db) are opened on one of them, picked by round robin or, with
+WEBSTR_REPLICA_SELECTION=least_connections, by the fewest connections checked out. A replica that
+fails to connect or loses its connection is skipped for WEBSTR_REPLICA_RETRY_INTERVAL seconds, and
+reads go to the primary when no replica is available. Writes, including the loaders in
+database_setup which connect to the URL they are given, always go to the primary.
+"""
+REPLICA_URLS = [url.strip().replace("postgres://", "postgresql+psycopg2://")
+                for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_SELECTION = os.environ.get("WEBSTR_REPLICA_SELECTION", "round_robin")
+REPLICA_RETRY_INTERVAL = float(os.environ.get("WEBSTR_REPLICA_RETRY_INTERVAL", "30"))
+
+class Replica(object):
+    def __init__(self, name, db_url):
+        self.name = name
+        self.engine = configure_connections(create_engine(db_url, echo=False, **engine_options(db_url)))
+        async_url = async_db_url(db_url)
+        self.async_engine = create_async_engine(async_url, echo=False, **engine_options(async_url, AsyncAdaptedQueuePool))
+        configure_connections(self.async_engine.sync_engine)
+        self.failed_at = None
+
+    def checked_out(self, use_async):
+        pool = (self.async_engine.sync_engine if use_async else self.engine).pool
+        return pool.checkedout() if hasattr(pool, "checkedout") else 0
+
+class ReplicaRouter(object):
+    """ Picks the replica for a read session among the ones that are currently available """
+    def __init__(self, replicas, selection=REPLICA_SELECTION, retry_interval=REPLICA_RETRY_INTERVAL):
+        self.replicas = replicas
+        self.selection = selection
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def available(self):
+        now = time.monotonic()
+        return [replica for replica in self.replicas
+                if replica.failed_at is None or now - replica.failed_at >= self.retry_interval]
+
+    def choose(self, use_async=False):
+        """ Replica to read from, None to read from the primary """
+        replicas = self.available()
+        if not replicas:
+            return None
+        with self.lock:
+            offset = next(self.counter) % len(replicas)
+        # Rotating the candidates spreads ties in least_connections mode as well
+        replicas = replicas[offset:] + replicas[:offset]
+        if self.selection == "least_connections":
+            return min(replicas, key=lambda replica: replica.checked_out(use_async))
+        return replicas[0]
+
+    def mark_failed(self, replica):
+        if replica.failed_at is None:
+            logging.warning(f"Database: replica {replica.name} unavailable, retrying in {self.retry_interval:.0f} s")
+        replica.failed_at = time.monotonic()
+
+    def mark_healthy(self, replica):
+        if replica.failed_at is not None:
+            logging.info(f"Database: replica {replica.name} available again")
+        replica.failed_at = None
+
+replica_router = ReplicaRouter([Replica(f"replica{i}", url) for i, url in enumerate(REPLICA_URLS)])
+
+def replica_disconnect_listener(replica):
+    def handle_error(context):
+        if context.is_disconnect:
+            replica_router.mark_failed(replica)
+    return handle_error
+
+for replica in replica_router.replicas:
+    for replica_engine, pool_name in ((replica.engine, replica.name), (replica.async_engine.sync_engine, f"{replica.name}_async")):
+        event.listen(replica_engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(replica_engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(replica_engine, "handle_error", replica_disconnect_listener(replica))
+        metrics.register_pool(replica_engine, pool_name)
+
+def checkout(session):
+    # Check the connection out up front to measure how long requests wait for the pool
+    start = time.perf_counter()
+    session.connection()
+    metrics.pool_checkout_wait.observe(time.perf_counter() - start)
+
+async def async_checkout(session):
+    start = time.perf_counter()
+    await session.connection()
+    metrics.pool_checkout_wait.observe(time.perf_counter() - start)
+
 def get_db():
   with Session(engine) as session:
+    checkout(session)
+    yield session
+
+async def get_async_db():
+  async with AsyncSession(async_engine) as session:
+    await async_checkout(session)
+    yield session
+
+def read_session():
+    """ Session on a replica if one is available, on the primary otherwise """
+    replica = replica_router.choose()
+    if replica is not None:
+        session = Session(replica.engine)
+        try:
+            checkout(session)
+            replica_router.mark_healthy(replica)
+            metrics.record_read_session(replica.name)
+            return session
+        except DBAPIError:
+            session.close()
+            replica_router.mark_failed(replica)
+
+    session = Session(engine)
+    checkout(session)
+    metrics.record_read_session("primary")
+    return session
+
+async def async_read_session():
+    replica = replica_router.choose(use_async=True)
+    if replica is not None:
+        session = AsyncSession(replica.async_engine)
+        try:
+            await async_checkout(session)
+            replica_router.mark_healthy(replica)
+            metrics.record_read_session(replica.name)
+            return session
+        except Exception:
+            # asyncpg's connect errors are not wrapped in DBAPIError, a refused or timed out
+            # connection raises OSError or asyncio.TimeoutError and others come from asyncpg itself
+            await session.close()
+            replica_router.mark_failed(replica)
+
+    session = AsyncSession(async_engine)
+    await async_checkout(session)
+    metrics.record_read_session("primary")
+    return session
+
+def get_read_db():
+  with read_session() as session:
+    yield session
+
+async def get_async_read_db():
+  async with await async_read_session() as session:
     yield session
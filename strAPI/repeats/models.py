@@ -1,5 +1,6 @@
+from datetime import datetime
 from typing import Optional, List, Dict
-from sqlalchemy import Integer, CheckConstraint, UniqueConstraint, ForeignKeyConstraint
+from sqlalchemy import Integer, CheckConstraint, UniqueConstraint, ForeignKeyConstraint, Index
 from sqlmodel import SQLModel, Field, Relationship, JSON, Column
 
 class ExonTranscriptsLink(SQLModel, table=True):
@@ -61,7 +62,8 @@ class Transcript(SQLModel, table=True):
 
 class Gene(SQLModel, table=True):
     __tablename__ = "genes"
-    __table_args__ = (UniqueConstraint("ensembl_version_id"), CheckConstraint("strand in ('+', '-')"))
+    __table_args__ = (UniqueConstraint("ensembl_version_id"), CheckConstraint("strand in ('+', '-')"),
+                      Index("ix_genes_chr_bin_start", "chr", "bin", "start"))
 
     id: int = Field(default=None, primary_key=True)
     ensembl_id: str = Field(nullable=False)
@@ -73,6 +75,8 @@ class Gene(SQLModel, table=True):
     strand: str = Field(nullable=False)
     start: int = Field(nullable=False)
     end: int = Field(nullable=False)    
+    # UCSC bin of the gene, see strAPI/utils/binning.py
+    bin: Optional[int] = Field(default=None, index=True)
 
     # one to many Genome -> Genes
     genome_id: int = Field(foreign_key ="genomes.id")
@@ -127,6 +131,7 @@ class Exon(SQLModel, table=True):
 
 class CRCVariation(SQLModel, table=True):
     __tablename__ = "crcvariations"
+    __table_args__ = (UniqueConstraint("repeat_id", name="uq_crcvariations_repeat_id"),)
 
     id: int = Field(primary_key=True)   
     instable_calls: Optional[int] = Field(default = None)
@@ -150,6 +155,7 @@ Example values
 """
 class AlleleFrequency(SQLModel, table=True):
     __tablename__ = "allele_frequencies"
+    __table_args__ = (Index("ix_allele_frequencies_repeat_id_population", "repeat_id", "population"),)
 
     id: int = Field(primary_key=True) 
 
@@ -187,6 +193,7 @@ class AlleleFrequency(SQLModel, table=True):
 
 class Repeat(SQLModel, table=True):
     __tablename__ = "repeats"
+    __table_args__ = (Index("ix_repeats_chr_bin_start", "chr", "bin", "start"),)
 
     id: int = Field(primary_key=True)   
     source: Optional[str] = Field(default="unknown")# e.g. which detector found this Repeat?
@@ -195,6 +202,8 @@ class Repeat(SQLModel, table=True):
     motif: str = Field(nullable=True)
     start: int = Field(nullable=False)
     end: int = Field(nullable=False)
+    # UCSC bin of the repeat, see strAPI/utils/binning.py
+    bin: Optional[int] = Field(default=None, index=True)
     l_effective: int = Field(nullable=False)
     n_effective: int = Field(nullable=False)
     region_length: int = Field(nullable=False)
@@ -352,9 +361,47 @@ class CRCExprRepeatLenCorr(SQLModel, table=True):
             self.repeat.start,
             self.p_value
         )
+"""
+Version of the data in the database, a single row bumped by the database_setup loaders after
+every load (see database_setup/data_version.py). The API keys its caches on it
+"""
+class DatasetVersion(SQLModel, table=True):
+    __tablename__ = "dataset_version"
 
+    id: int = Field(default=None, primary_key=True)
+    version: int = Field(nullable=False)
+    updated_at: datetime = Field(nullable=False)
+    # Loader that made the last change
+    source: Optional[str] = Field(default=None)
 
+    def __repr__(self):
+        return "DatasetVersion(version={}, updated_at={}, source={})".format(
+            self.version,
+            self.updated_at,
+            self.source
+        )
 
+"""
+Progress of the ETL run by database_setup/etl.py: one row per stage and chunk of a stage (e.g. a
+chromosome file), so an interrupted run resumes after the last completed chunk
+"""
+class EtlCheckpoint(SQLModel, table=True):
+    __tablename__ = "etl_checkpoints"
+
+    stage: str = Field(primary_key=True)
+    chunk: str = Field(primary_key=True)
+    # running, done or failed
+    status: str = Field(nullable=False)
+    # Rows the chunk added to the tables of its stage
+    rows: Optional[int] = Field(default=None)
+    started_at: Optional[datetime] = Field(default=None)
+    finished_at: Optional[datetime] = Field(default=None)
+    error: Optional[str] = Field(default=None)
 
-
-
+    def __repr__(self):
+        return "EtlCheckpoint(stage={}, chunk={}, status={}, rows={})".format(
+            self.stage,
+            self.chunk,
+            self.status,
+            self.rows
+        )
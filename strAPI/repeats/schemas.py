@@ -1,6 +1,8 @@
 from datetime import date
 from typing import Optional, List, Tuple
-from pydantic import BaseModel
+import os
+
+from pydantic import BaseModel, conlist, constr
 
 class Gene(BaseModel):
     ensembl_id: str
@@ -72,6 +74,15 @@ class RepeatInfo(BaseModel):
     class Config:
         orm_mode = True
 
+# Maximum number of repeat ids per request of the batch endpoints
+BATCH_MAX_IDS = int(os.environ.get("WEBSTR_BATCH_MAX_IDS", "50000"))
+
+# Region queries as parse_region reads them, e.g. 1:182393-1014541
+REGION_REGEX = r"^[^:]+:[0-9]+-[0-9]+$"
+
+class RepeatInfoBatch(BaseModel):
+    repeat_ids: conlist(int, min_items=1, max_items=BATCH_MAX_IDS)
+
 class AlleleFrequency(BaseModel):
     population: str
     n_effective: int
@@ -83,13 +94,35 @@ class AlleleFrequency(BaseModel):
     class Config:
         orm_mode = True
 
+class AlleleFrequencyBatch(BaseModel):
+    """ Repeats given by id or by a region such as '1:182393-1014541', optionally limited to some
+    populations, e.g. '1000 Genomes AFR'
+    """
+    repeat_ids: Optional[conlist(int, min_items=1, max_items=BATCH_MAX_IDS)]
+    region_query: Optional[constr(regex=REGION_REGEX)]
+    populations: Optional[List[str]]
+
+class PopulationAlleleFrequencies(BaseModel):
+    """ Allele frequencies of a repeat in one population, frequency[i] being the frequency of
+    alleles of n_effective[i] copies
+    """
+    population: str
+    n_effective: List[int]
+    frequency: List[float]
+    het: Optional[float]
+    num_called: Optional[int]
+
+class RepeatAlleleFrequencies(BaseModel):
+    repeat_id: int
+    populations: List[PopulationAlleleFrequencies]
+
 class CRCVariation(BaseModel):
-    tcga_barcode: str
-    sample_type: str
-    start: int
-    end: int
-    reference: int
-    alt: int
+    id: int
+    instable_calls: Optional[int]
+    stable_calls: Optional[int]
+    total_calls: Optional[int]
+    frac_variable: Optional[float]
+    avg_size_diff: Optional[float]
     repeat_id: int
 
     class Config:
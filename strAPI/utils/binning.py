@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+""" UCSC-style hierarchical binning of genomic intervals (Kent et al., 2002)
+
+Every interval is stored in the smallest bin that fully contains it. Bins are 128kb at the
+finest level and grow 8-fold per level up to a single 512Mb bin, so a region query only has
+to look at a handful of bin ranges instead of scanning the whole chromosome.
+
+Coordinates are 1-based and inclusive, as in the rest of the database.
+"""
+from sqlalchemy import or_
+
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+def region_to_bin(start, end):
+    """ Return the smallest bin that fully contains the region start-end
+    """
+    start_bin = (max(start, 1) - 1) >> BIN_FIRST_SHIFT
+    end_bin = (max(end, 1) - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if start_bin == end_bin:
+            return offset + start_bin
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    raise ValueError(f"Region {start}-{end} is out of range of the binning scheme")
+
+def region_to_bin_ranges(start, end):
+    """ Return (first, last) bin ranges, one per level, that together hold every interval
+    overlapping the region start-end
+    """
+    start_bin = (max(start, 1) - 1) >> BIN_FIRST_SHIFT
+    end_bin = (max(end, 1) - 1) >> BIN_FIRST_SHIFT
+    ranges = []
+    for offset in BIN_OFFSETS:
+        ranges.append((offset + start_bin, offset + end_bin))
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    return ranges
+
+def bin_filter(bin_column, start, end):
+    """ SQL clause restricting bin_column to the bins that can overlap the region start-end
+    """
+    return or_(*(bin_column.between(first, last) for first, last in region_to_bin_ranges(start, end)))
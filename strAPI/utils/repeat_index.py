@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+""" In-memory interval index over the repeat catalogue
+
+For every chromosome the (start, end, repeat_id, trpanel_id, l_effective) of all repeats are
+kept in NumPy arrays sorted by start, so region queries are answered with a binary search
+instead of a range scan in the database. Only the matching repeat ids are returned, the rows
+themselves still come from the database.
+
+The index is built on a background thread when the API starts (see start_repeat_index) and
+rebuilt there when the dataset version (models.DatasetVersion, bumped by the loaders) changes,
+which is checked at most every REFRESH_INTERVAL seconds. A new index replaces the old one in a
+single assignment, so requests never wait for a build: they use the index they find, or the
+range scan in the database while the first one is being built.
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from sqlmodel import select
+
+from ..repeats.models import Repeat, DatasetVersion
+from ..repeats.database import read_session
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = int(os.environ.get("WEBSTR_REPEAT_INDEX_REFRESH_INTERVAL", "300"))
+
+class ChromosomeIntervals(object):
+    """ Repeats of a single chromosome as arrays sorted by start position
+    """
+    def __init__(self, starts, ends, repeat_ids, trpanel_ids, l_effectives):
+        order = np.argsort(starts, kind="stable")
+        self.starts = np.asarray(starts, dtype=np.int64)[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.repeat_ids = np.asarray(repeat_ids, dtype=np.int64)[order]
+        self.trpanel_ids = np.asarray(trpanel_ids, dtype=np.int32)[order]
+        self.l_effectives = np.asarray(l_effectives, dtype=np.int32)[order]
+        # No repeat is longer than this, bounds how far left of a query an overlapping repeat can start
+        self.max_length = int((self.ends - self.starts).max()) + 1 if len(self.starts) else 0
+
+    def _select(self, lo, hi, mask, max_period):
+        if max_period is not None:
+            mask &= self.l_effectives[lo:hi] <= max_period
+        return self.repeat_ids[lo:hi][mask]
+
+    def contained(self, start, end, max_period=None):
+        """ Ids of repeats lying entirely within start-end """
+        lo = np.searchsorted(self.starts, start, side="left")
+        hi = np.searchsorted(self.starts, end, side="right")
+        return self._select(lo, hi, self.ends[lo:hi] <= end, max_period)
+
+    def overlapping(self, start, end, max_period=None):
+        """ Ids of repeats sharing at least one position with start-end """
+        lo = np.searchsorted(self.starts, start - self.max_length, side="left")
+        hi = np.searchsorted(self.starts, end, side="right")
+        return self._select(lo, hi, self.ends[lo:hi] >= start, max_period)
+
+class RepeatIndex(object):
+    def __init__(self, chromosomes, version):
+        self.chromosomes = chromosomes
+        self.version = version
+
+    @staticmethod
+    def current_version(db):
+        """ Dataset version of the database, None if no loader has set one """
+        return db.exec(select(DatasetVersion.version).where(DatasetVersion.id == 1)).first()
+
+    @classmethod
+    def from_db(cls, db):
+        version = cls.current_version(db)
+        statement = select(Repeat.chr, Repeat.start, Repeat.end, Repeat.id, Repeat.trpanel_id, Repeat.l_effective
+            ).order_by(Repeat.chr)
+
+        chromosomes = dict()
+        columns = None
+        current_chr = None
+        for chrom, *values in db.exec(statement):
+            if chrom != current_chr:
+                if columns is not None:
+                    chromosomes[current_chr] = ChromosomeIntervals(*columns)
+                columns = ([], [], [], [], [])
+                current_chr = chrom
+            for column, value in zip(columns, values):
+                column.append(value)
+        if columns is not None:
+            chromosomes[current_chr] = ChromosomeIntervals(*columns)
+
+        return cls(chromosomes, version)
+
+    def contained(self, chrom, start, end, max_period=None):
+        if chrom not in self.chromosomes:
+            return []
+        return self.chromosomes[chrom].contained(start, end, max_period).tolist()
+
+    def overlapping(self, chrom, start, end, max_period=None):
+        if chrom not in self.chromosomes:
+            return []
+        return self.chromosomes[chrom].overlapping(start, end, max_period).tolist()
+
+_index = None
+_checked_at = None
+_building = threading.Lock()
+
+def refresh_repeat_index():
+    """ Build a new index if the dataset version changed since the current one was built and
+    swap it in
+    """
+    global _index
+
+    with read_session() as db:
+        version = RepeatIndex.current_version(db)
+        if _index is None or _index.version != version:
+            _index = RepeatIndex.from_db(db)
+
+def _build():
+    try:
+        refresh_repeat_index()
+    except Exception:
+        logger.exception("Could not build the repeat index")
+    finally:
+        _building.release()
+
+def start_repeat_index():
+    """ Check for a new dataset version and build the index on a background thread, unless a
+    build is already running
+    """
+    global _checked_at
+
+    _checked_at = time.monotonic()
+    if _building.acquire(blocking=False):
+        threading.Thread(target=_build, name="repeat-index", daemon=True).start()
+
+def get_repeat_index():
+    """ Return the process-wide RepeatIndex, None until the first build has finished. Starts a
+    rebuild in the background when the last check for a new dataset version is older than
+    REFRESH_INTERVAL
+    """
+    if _checked_at is None or time.monotonic() - _checked_at >= REFRESH_INTERVAL:
+        start_repeat_index()
+    index = _index
+    metrics.record_cache("repeat_index", index is not None)
+    return index
+
+def invalidate_repeat_index():
+    """ Drop the index and build it again in the background """
+    global _index
+    _index = None
+    start_repeat_index()
@@ -0,0 +1,67 @@
+""" Test database and API client
+
+The API connects to DATABASE_URL when strAPI is imported, so a SQLite file database is set up
+before that and filled with a small fixture: gene G1 with one repeat and gene G2 with five, each
+repeat with CRC variation stats, allele frequencies of two populations and an expression
+correlation with its gene.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="webstr-tests-"), "test.sqlite")
+
+# Requests open and close their session in different threads of the thread pool
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}?check_same_thread=false"
+os.environ.pop("DATABASE_REPLICA_URLS", None)
+# The version check of the HTTP cache would add a statement to some requests only
+os.environ["WEBSTR_HTTP_CACHE_ENABLE"] = "0"
+sys.path.insert(0, ROOT)
+# The API serves /static from the working directory
+os.chdir(ROOT)
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import SQLModel, Session
+
+from strAPI.repeats import models
+from strAPI.repeats import database
+from strAPI.utils.binning import region_to_bin
+
+REPEATS_PER_GENE = {"G1": 1, "G2": 5}
+
+def make_fixture(engine):
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(models.Genome(id=1, name="hg38", organism="Homo Sapiens", version="GRCh38.p2"))
+        session.add(models.TRPanel(id=1, name="gangstr_crc_hg38", method="GangSTR", genome_id=1))
+        repeat_id = 1
+        for gene_id, (name, n_repeats) in enumerate(REPEATS_PER_GENE.items(), start=1):
+            gene_start = gene_id * 10000
+            session.add(models.Gene(id=gene_id, ensembl_id=f"ENSG{gene_id}", ensembl_version_id=f"ENSG{gene_id}.1", name=name,
+                                    description=f"gene {name}", chr="chr1", strand="+", start=gene_start, end=gene_start + 5000,
+                                    bin=region_to_bin(gene_start, gene_start + 5000), genome_id=1))
+            for i in range(n_repeats):
+                start = gene_start + 100 + i * 100
+                session.add(models.Repeat(id=repeat_id, chr="chr1", msa="AC,AC", motif="AC", start=start, end=start + 19,
+                                          bin=region_to_bin(start, start + 19), l_effective=2, n_effective=10, region_length=20,
+                                          score_type="phylo_gap01", score=1.0, p_value=0.01, divergence=0.0, trpanel_id=1))
+                session.add(models.GenesRepeatsLink(repeat_id=repeat_id, gene_id=gene_id))
+                session.add(models.CRCVariation(id=repeat_id, repeat_id=repeat_id, total_calls=10, frac_variable=0.5, avg_size_diff=0.1))
+                for population in ("AFR", "EUR"):
+                    session.add(models.AlleleFrequency(population=f"1000 Genomes {population}", n_effective=10, frequency=1.0,
+                                                       het=0.0, num_called=10, repeat_id=repeat_id))
+                session.add(models.CRCExprRepeatLenCorr(repeat_id=repeat_id, gene_id=gene_id, p_value=0.01, p_value_corrected=0.05,
+                                                        coefficient=0.1 * repeat_id, intercept=0.0))
+                repeat_id += 1
+        session.commit()
+
+make_fixture(database.engine)
+
+from strAPI.main import app
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(app) as client:
+        yield client
@@ -0,0 +1,16 @@
+import pytest
+
+def test_batch_by_region(client):
+    response = client.post("/allfreqs/batch", json={"region_query": "1:20000-21000", "populations": ["1000 Genomes AFR"]})
+    assert response.status_code == 200
+    assert [row["repeat_id"] for row in response.json()] == [2, 3, 4, 5, 6]
+    assert all(len(row["populations"]) == 1 for row in response.json())
+
+def test_batch_needs_ids_or_region(client):
+    response = client.post("/allfreqs/batch", json={"populations": ["1000 Genomes AFR"]})
+    assert response.status_code == 400
+
+@pytest.mark.parametrize("region_query", ["bogus", "1:100", "1:a-b", "1:100-200:300"])
+def test_batch_rejects_invalid_region(client, region_query):
+    response = client.post("/allfreqs/batch", json={"region_query": region_query})
+    assert response.status_code == 422
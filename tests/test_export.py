@@ -0,0 +1,43 @@
+import io
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from strAPI import export
+from strAPI import repeat_queries as rq
+
+def read_table(response, output_format):
+    data = io.BytesIO(response.content)
+    if output_format == "arrow":
+        return pa.ipc.open_stream(data).read_all()
+    return pq.read_table(data)
+
+ENDPOINTS = [
+    ("/repeats", {"gene_names": "G2"}, rq.REPEAT_COLUMNS, 5),
+    ("/allfreqs/", {"repeat_id": 2}, rq.ALLELE_FREQUENCY_COLUMNS, 2),
+    ("/variations/", {"gene_names": "G2"}, rq.VARIATION_COLUMNS, 5),
+]
+
+@pytest.mark.parametrize("output_format", ["arrow", "parquet"])
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("path, params, columns, num_rows", ENDPOINTS)
+def test_columnar_download(client, path, params, columns, num_rows, output_format, compress):
+    response = client.get(path, params={**params, "format": output_format, "compress": compress})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == export.MEDIA_TYPES[output_format]
+
+    table = read_table(response, output_format)
+    assert table.schema == export.arrow_schema(columns)
+    assert table.num_rows == num_rows
+
+def test_variations_columns_match_the_model():
+    assert rq.VARIATION_COLUMNS == [("id", "int64"), ("instable_calls", "int64"), ("stable_calls", "int64"),
+        ("total_calls", "int64"), ("frac_variable", "double"), ("avg_size_diff", "double"), ("repeat_id", "int64")]
+
+def test_variations_columnar_values(client):
+    response = client.get("/variations/", params={"gene_names": "G2", "format": "parquet"})
+    rows = read_table(response, "parquet").to_pylist()
+
+    assert [row["repeat_id"] for row in rows] == [2, 3, 4, 5, 6]
+    assert all(row["total_calls"] == 10 and row["instable_calls"] is None for row in rows)
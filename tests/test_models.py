@@ -0,0 +1,12 @@
+import pytest
+
+from strAPI.repeats import models
+
+@pytest.mark.parametrize("model", [models.Repeat, models.Gene])
+def test_bin_indexes_match_the_migration(model):
+    # Created by migration b330076d4d25 (interval bins)
+    table = model.__table__.name
+    indexes = {index.name: [column.name for column in index.columns] for index in model.__table__.indexes
+               if "bin" in index.columns}
+
+    assert indexes == {f"ix_{table}_bin": ["bin"], f"ix_{table}_chr_bin_start": ["chr", "bin", "start"]}
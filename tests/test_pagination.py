@@ -0,0 +1,43 @@
+import base64
+import json
+
+import pytest
+
+from strAPI import pagination
+
+def token(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+@pytest.mark.parametrize("page_token", [
+    "not base64!", token({"a": 1}), token([0.5, 10]), token([{"a": 1}, [1], None, 1]), token([True, 10, 1, 1]),
+])
+def test_invalid_page_token(client, page_token):
+    response = client.get("/repeats", params={"gene_names": "G2", "page_token": page_token})
+    assert response.status_code == 400
+
+def test_pages_of_repeats(client):
+    first = client.get("/repeats", params={"gene_names": "G2", "page_size": 3})
+    assert first.status_code == 200
+    next_token = first.headers["X-Next-Page-Token"]
+    assert pagination.decode_token(next_token, 4)[2] == first.json()[-1]["repeat_id"]
+
+    second = client.get("/repeats", params={"gene_names": "G2", "page_size": 3, "page_token": next_token})
+    assert second.status_code == 200
+    assert "X-Next-Page-Token" not in second.headers
+    assert [row["repeat_id"] for row in first.json() + second.json()] == [2, 3, 4, 5, 6]
+
+def test_correlations_limit_is_an_alias_of_page_size(client):
+    by_page_size = client.get("/crc_expr_repeatlen_corr/", params={"page_size": 2})
+    by_limit = client.get("/crc_expr_repeatlen_corr/", params={"limit": 2})
+    assert by_page_size.status_code == by_limit.status_code == 200
+    assert len(by_limit.json()) == 2
+    assert by_limit.json() == by_page_size.json()
+    assert by_limit.headers["X-Next-Page-Token"] == by_page_size.headers["X-Next-Page-Token"]
+
+def test_next_page_headers_are_exposed_cross_origin(client):
+    response = client.get("/repeats", params={"gene_names": "G2", "page_size": 3}, headers={"Origin": "https://webstr.example.org"})
+    assert response.status_code == 200
+    assert "X-Next-Page-Token" in response.headers
+    exposed = [header.strip().lower() for header in response.headers["Access-Control-Expose-Headers"].split(",")]
+    assert "x-next-page-token" in exposed
+    assert "link" in exposed
@@ -0,0 +1,56 @@
+import time
+from datetime import datetime
+
+import pytest
+from sqlmodel import Session
+
+from strAPI import repeat_queries as rq
+from strAPI.repeats import database, models
+from strAPI.utils import repeat_index
+
+REGION = "1:10000-21000"
+
+def all_repeats(client, page_size):
+    """ repeat_id, gene_name pairs of every page of REGION """
+    rows, params = [], {"region_query": REGION, "page_size": page_size}
+    while True:
+        response = client.get("/repeats", params=params)
+        assert response.status_code == 200
+        rows.extend((row["repeat_id"], row["gene_name"]) for row in response.json())
+        if "X-Next-Page-Token" not in response.headers:
+            return rows
+        params["page_token"] = response.headers["X-Next-Page-Token"]
+
+@pytest.fixture
+def built_index(monkeypatch):
+    monkeypatch.setattr(rq, "REPEAT_INDEX_ENABLED", True)
+    repeat_index.refresh_repeat_index()
+    # No background refresh during the test
+    monkeypatch.setattr(repeat_index, "_checked_at", time.monotonic())
+    yield repeat_index._index
+
+def test_region_repeat_ids_without_index(monkeypatch):
+    monkeypatch.setattr(repeat_index, "_index", None)
+    monkeypatch.setattr(repeat_index, "_checked_at", time.monotonic())
+    assert rq.region_repeat_ids(REGION) is None
+
+def test_index_pages_match_the_range_scan(client, built_index, monkeypatch):
+    scanned = all_repeats(client, page_size=100)
+    assert len(scanned) == 6
+
+    assert built_index.contained("chr1", 10000, 21000) == [1, 2, 3, 4, 5, 6]
+    assert all_repeats(client, page_size=100) == scanned
+    # Pages merged from several statements, one per chunk of ids
+    monkeypatch.setattr(rq, "REPEAT_ID_CHUNK_SIZE", 4)
+    assert all_repeats(client, page_size=2) == scanned
+
+def test_index_is_rebuilt_on_a_new_dataset_version(built_index):
+    repeat_index.refresh_repeat_index()
+    assert repeat_index._index is built_index
+
+    with Session(database.engine) as session:
+        session.merge(models.DatasetVersion(id=1, version=(built_index.version or 0) + 1, updated_at=datetime.utcnow()))
+        session.commit()
+    repeat_index.refresh_repeat_index()
+    assert repeat_index._index is not built_index
+    assert repeat_index._index.version == (built_index.version or 0) + 1
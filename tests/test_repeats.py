@@ -0,0 +1,68 @@
+import csv
+import io
+
+from sqlalchemy import event
+
+from strAPI.repeats import database
+
+from conftest import REPEATS_PER_GENE
+
+class StatementCounter(object):
+    """ Counts the statements run on the async engine, which serves /repeats """
+    def __init__(self):
+        self.statements = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    def __enter__(self):
+        event.listen(database.async_engine.sync_engine, "after_cursor_execute", self)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(database.async_engine.sync_engine, "after_cursor_execute", self)
+
+def count_statements(client, gene_name):
+    with StatementCounter() as counter:
+        response = client.get("/repeats", params={"gene_names": gene_name})
+    assert response.status_code == 200
+    assert len(response.json()) == REPEATS_PER_GENE[gene_name]
+    return counter.statements
+
+def test_repeats_statements_dont_grow_with_the_repeats(client):
+    # Warm up, the first request may open the connection
+    count_statements(client, "G1")
+
+    one_repeat = count_statements(client, "G1")
+    five_repeats = count_statements(client, "G2")
+
+    assert one_repeat == five_repeats == 1
+
+def test_repeats_returns_gene_and_variation_stats(client):
+    repeats = client.get("/repeats", params={"gene_names": "G2"}).json()
+
+    assert {repeat["gene_name"] for repeat in repeats} == {"G2"}
+    assert all(repeat["total_calls"] == 10 for repeat in repeats)
+
+def test_repeats_in_region(client):
+    # Repeats of G2 start at 20100, 20200, ... and are 20 bp long
+    repeats = client.get("/repeats", params={"region_query": "1:20150-20410"}).json()
+
+    assert sorted(repeat["repeat_id"] for repeat in repeats) == [3, 4]
+
+def test_variations_of_genes(client):
+    response = client.get("/variations/", params={"gene_names": "G2"})
+    assert response.status_code == 200
+
+    variations = response.json()
+    assert [variation["repeat_id"] for variation in variations] == [2, 3, 4, 5, 6]
+    assert all(variation["total_calls"] == 10 and variation["frac_variable"] == 0.5 for variation in variations)
+
+def test_variations_download(client):
+    response = client.get("/variations/", params={"gene_names": "G2", "download": True})
+    assert response.status_code == 200
+
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [int(row["repeat_id"]) for row in rows] == [2, 3, 4, 5, 6]
+    assert list(rows[0]) == ["id", "instable_calls", "stable_calls", "total_calls", "frac_variable", "avg_size_diff", "repeat_id"]
+    assert float(rows[0]["avg_size_diff"]) == 0.1